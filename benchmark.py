@@ -0,0 +1,404 @@
+# This script measures the speed of REPO on synthetic Packages files, offline.
+
+# It generates a Packages file with generate_packages.py, then times:
+# - parse: parsing it with json_parser.parse_packages() and the streaming iter_packages();
+# - format: rewriting it with format_packages.update_package_info();
+# - serialize: encoding the parsed packages as pretty-printed JSON (Packages.json)
+#   and as the compact, compressed body served by server.py;
+# - convert: the whole json_parser.py pipeline on one file, to JSON and to SQLite;
+# - server: request latencies of a local uvicorn instance serving the converted output.
+
+# Each benchmark runs in a fresh process so its peak RSS can be reported on its own.
+# Results are saved as JSON (by default in tmp/) and can be compared with a previous run.
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from setup_logging import setup_logging
+
+BENCHMARKS = ("parse", "format", "serialize", "convert", "server")
+
+# Requests sent to the server, as (name, path and query string, extra headers)
+SERVER_SCENARIOS = (
+    # requests sends "Accept-Encoding: gzip, deflate" unless told otherwise
+    ("full_list", "/packages/?architecture=amd64&branch=main", {"Accept-Encoding": "identity"}),
+    ("full_list_gzip", "/packages/?architecture=amd64&branch=main", {"Accept-Encoding": "gzip"}),
+    ("package_lookup", "/packages/?architecture=amd64&branch=main&package_name={name}", {}),
+    ("page", "/packages/?architecture=amd64&branch=main&limit=100&cursor={offset}&fields=Package,Version", {}),
+    ("search", "/search?architecture=amd64&branch=main&q={word}", {}),
+    ("closure", "/packages/{name}/closure?architecture=amd64&branch=main", {}),
+)
+
+SEARCH_WORDS = ("library", "network", "graphical", "protocol", "shared", "plugin")
+
+# How long to wait for the server to accept connections, in seconds
+SERVER_STARTUP_TIMEOUT = 30
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of the current process, in MiB.
+    """
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def best_time(function, repeat):
+    """
+    Call a function several times and return the shortest duration, in seconds, and its last result.
+    """
+
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def throughput(size, count, seconds):
+    """
+    Return the usual throughput metrics of a pass over a Packages file.
+    """
+
+    return {
+        "seconds": round(seconds, 4),
+        "mb_per_s": round(size / (1024 * 1024) / seconds, 2),
+        "stanzas_per_s": round(count / seconds),
+    }
+
+def bench_parse(packages_path, repeat):
+    from json_parser import iter_packages, parse_packages
+    from stanza_parser import open_packages
+
+    size = os.path.getsize(packages_path)
+
+    def parse_in_memory():
+        with open(packages_path, "r", encoding="utf-8") as file:
+            return len(parse_packages(file.read()))
+
+    def parse_streaming():
+        with open_packages(packages_path) as file:
+            return sum(1 for _ in iter_packages(file))
+
+    in_memory_seconds, count = best_time(parse_in_memory, repeat)
+    streaming_seconds, _ = best_time(parse_streaming, repeat)
+
+    return {
+        "parse_packages": throughput(size, count, in_memory_seconds),
+        "iter_packages": throughput(size, count, streaming_seconds),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def bench_format(packages_path, work_directory, repeat):
+    from format_packages import update_package_info
+
+    size = os.path.getsize(packages_path)
+    output_path = os.path.join(work_directory, "Packages.formatted")
+
+    seconds, _ = best_time(lambda: update_package_info(packages_path, output_path, progress=False), repeat)
+    with open(packages_path, "r", encoding="utf-8") as file:
+        count = sum(1 for line in file if line.startswith("Package:"))
+    os.remove(output_path)
+
+    return {"update_package_info": throughput(size, count, seconds), "peak_rss_mb": peak_rss_mb()}
+
+def bench_serialize(packages_path, work_directory, repeat):
+    from json_parser import iter_packages, write_json_array
+    from package_store import SerializedList
+    from stanza_parser import open_packages
+
+    with open_packages(packages_path) as file:
+        packages = list(iter_packages(file))
+    output_path = os.path.join(work_directory, "Packages.json")
+
+    def write_pretty():
+        with open(output_path, "w", encoding="utf-8") as json_file:
+            write_json_array(packages, json_file)
+
+    pretty_seconds, _ = best_time(write_pretty, repeat)
+    pretty_size = os.path.getsize(output_path)
+    os.remove(output_path)
+
+    # The server encodes the full list once per dataset version, then compresses it
+    served_seconds, serialized = best_time(lambda: SerializedList(packages, 0), repeat)
+
+    return {
+        "pretty_json": {
+            "seconds": round(pretty_seconds, 4),
+            "bytes": pretty_size,
+            "mb_per_s": round(pretty_size / (1024 * 1024) / pretty_seconds, 2),
+        },
+        "served_list": {
+            "seconds": round(served_seconds, 4),
+            "bytes": {encoding: len(body) for encoding, body in serialized.bodies.items()},
+        },
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def bench_convert(input_directory, output_directory, formats):
+    from json_parser import find_packages_files, process_packages_file
+
+    input_path = find_packages_files(input_directory)[0]
+    size = os.path.getsize(input_path)
+
+    start = time.perf_counter()
+    _, count, _ = process_packages_file(input_path, output_directory, input_directory, True, formats)
+    seconds = time.perf_counter() - start
+
+    return {**throughput(size, count, seconds), "peak_rss_mb": peak_rss_mb()}
+
+def run_isolated(function, *args):
+    """
+    Run a benchmark function in a new process, so its memory use is measured on its own.
+    """
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+def percentiles(latencies):
+    """
+    Summarize request latencies, given in seconds, in milliseconds.
+    """
+
+    ordered = sorted(latencies)
+
+    def percentile(fraction):
+        # Nearest-rank percentile
+        index = max(int(round(fraction * len(ordered))) - 1, 0)
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(work_directory, port):
+    """
+    Start uvicorn serving server.py, with work_directory as the current directory (so output/ is found there).
+
+    Returns:
+        subprocess.Popen: The server process, once it accepts connections.
+    """
+
+    app_directory = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--app-dir", app_directory,
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=work_directory,
+    )
+
+    deadline = time.monotonic() + SERVER_STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError("The server did not start in time")
+
+def bench_server(work_directory, names, request_count, concurrency):
+    import requests
+
+    port = free_port()
+    process = start_server(work_directory, port)
+    base_url = f"http://127.0.0.1:{port}"
+    local = threading.local()
+
+    def send(url, headers):
+        # One connection per thread, kept alive between requests
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        response = session.get(url, headers=headers)
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for scenario, path, headers in SERVER_SCENARIOS:
+                urls = [base_url + path.format(name=names[i % len(names)], offset=(i * 100) % len(names),
+                                               word=SEARCH_WORDS[i % len(SEARCH_WORDS)])
+                        for i in range(request_count)]
+
+                # The first request of a scenario may load the dataset or build an index
+                cold = send(urls[0], headers)
+
+                start = time.perf_counter()
+                latencies = list(executor.map(lambda url: send(url, headers), urls))
+                elapsed = time.perf_counter() - start
+
+                results[scenario] = {
+                    "cold_ms": round(cold * 1000, 3),
+                    **percentiles(latencies),
+                    "requests_per_s": round(request_count / elapsed, 1),
+                }
+                logging.info(f"Server scenario {scenario}: {results[scenario]}")
+    finally:
+        process.terminate()
+        process.wait()
+
+    return results
+
+def flatten(results, prefix=""):
+    """
+    Flatten nested results into {"parse.iter_packages.seconds": value, ...}, keeping numbers only.
+    """
+
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare_results(previous, current):
+    """
+    Print the metrics of the current run next to those of a previous run.
+    """
+
+    if previous.get("parameters") != current["parameters"]:
+        print("Warning: the runs used different parameters, their results are not comparable")
+
+    old = flatten(previous["results"])
+    new = flatten(current["results"])
+
+    print(f"{'metric':<50} {'previous':>12} {'current':>12} {'change':>8}")
+    for name in sorted(old.keys() & new.keys()):
+        change = f"{(new[name] - old[name]) / old[name] * 100:+.1f}%" if old[name] else ""
+        print(f"{name:<50} {old[name]:>12} {new[name]:>12} {change:>8}")
+
+def run_benchmarks(args, work_directory):
+    """
+    Generate the input and run the selected benchmarks.
+
+    Returns:
+        dict: The results of each benchmark.
+    """
+
+    from generate_packages import generate_packages
+    from json_parser import iter_packages
+    from stanza_parser import open_packages
+
+    input_directory = os.path.join(work_directory, "input")
+    output_directory = os.path.join(work_directory, "output")
+    packages_path = os.path.join(input_directory, "main", "binary-amd64", "Packages")
+    os.makedirs(os.path.dirname(packages_path))
+
+    size = generate_packages(packages_path, args.count, args.description_lines, args.tags, args.depends, args.seed)
+    logging.info(f"Generated {args.count} packages ({size} bytes) in {packages_path}")
+
+    results = {}
+
+    if "parse" in args.only:
+        results["parse"] = run_isolated(bench_parse, packages_path, args.repeat)
+    if "format" in args.only:
+        results["format"] = run_isolated(bench_format, packages_path, work_directory, args.repeat)
+    if "serialize" in args.only:
+        results["serialize"] = run_isolated(bench_serialize, packages_path, work_directory, args.repeat)
+    if "convert" in args.only or "server" in args.only:
+        results["convert"] = {
+            "json": run_isolated(bench_convert, input_directory, output_directory, ("json",)),
+            "sqlite": run_isolated(bench_convert, input_directory, os.path.join(work_directory, "output-sqlite"), ("sqlite",)),
+        }
+    if "server" in args.only:
+        with open_packages(packages_path) as file:
+            names = [package["Package"] for package in iter_packages(file)]
+        results["server"] = bench_server(work_directory, names, args.requests, args.concurrency)
+
+    for name, result in results.items():
+        logging.info(f"Benchmark {name}: {result}")
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing, formatting, serialization and serving on synthetic Packages files.")
+    parser.add_argument("--count", type=int, default=20000, help="Number of package stanzas generated.")
+    parser.add_argument("--description-lines", type=int, default=6, help="Number of lines of each long description.")
+    parser.add_argument("--tags", type=int, default=6, help="Number of debtags of each package.")
+    parser.add_argument("--depends", type=int, default=12, help="Maximum number of Depends groups of each package.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generator, keep it to compare runs.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each timing, the best one is kept.")
+    parser.add_argument("--requests", type=int, default=200, help="Number of requests sent for each server scenario.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of concurrent connections to the server.")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS), help="Benchmarks to run.")
+    parser.add_argument("--work-directory", help="Directory for the generated files (default: a temporary directory, removed afterwards).")
+    parser.add_argument("--output", help="Path of the JSON results (default: tmp/benchmark-<time>.json).")
+    parser.add_argument("--compare", help="Path of the JSON results of a previous run to compare with.")
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    output_path = args.output or os.path.join(script_dir, "tmp", f"benchmark-{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}.json")
+
+    if args.work_directory:
+        os.makedirs(args.work_directory, exist_ok=True)
+        work_directory = tempfile.mkdtemp(dir=args.work_directory)
+    else:
+        work_directory = tempfile.mkdtemp(prefix="repo-benchmark-")
+
+    try:
+        results = run_benchmarks(args, work_directory)
+    finally:
+        if not args.work_directory:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    report = {
+        "created": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "count": args.count,
+            "description_lines": args.description_lines,
+            "tags": args.tags,
+            "depends": args.depends,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+        },
+        "results": results,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    logging.info(f"Results saved to {output_path}")
+    print(f"Results saved to {output_path}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            compare_results(json.load(file), report)
+    else:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    setup_logging('benchmark.log')
+    main()
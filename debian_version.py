@@ -0,0 +1,283 @@
+# This module compares Debian package versions the way dpkg does.
+
+# A version is made of [epoch:]upstream_version[-debian_revision]:
+# - the epoch is a number, 0 when omitted, and is compared first;
+# - upstream_version and debian_revision are compared part by part, alternating
+#   non-digit parts (compared character by character, letters before other
+#   characters, and "~" before anything, even the end of the part) and digit
+#   parts (compared numerically).
+# For example 1.0~rc1 < 1.0 < 1.0a < 1.0+dfsg < 1.0.1 < 1:0.1
+
+# version_key() turns a version into a string that sorts, as a plain string, in the
+# same order as compare_versions(). It is precomputed for every package by
+# json_parser.py, so sorting and range queries don't need to parse versions again.
+
+# min_version, /latest and dependency closures all rely on both functions agreeing with
+# dpkg: run this module (python3 debian_version.py, or make check) after changing it to
+# check them against KNOWN_ORDERINGS and against each other.
+
+import sys
+import random
+import operator
+
+# Relationship operators (the obsolete < and > mean <= and >=), applied either to
+# the result of compare_versions() and 0, or to two version keys
+RELATIONS = {
+    "<<": operator.lt,
+    "<=": operator.le,
+    "<": operator.le,
+    "=": operator.eq,
+    ">=": operator.ge,
+    ">": operator.ge,
+    ">>": operator.gt,
+}
+
+# Orderings dpkg is known to give, as (a, relation, b)
+KNOWN_ORDERINGS = [
+    # "~" sorts before anything, even the end of the version
+    ("1.0~rc1", "<<", "1.0"),
+    ("1.0~~", "<<", "1.0~"),
+    ("1.0~", "<<", "1.0"),
+    ("1.0~~a", "<<", "1.0~"),
+    ("1.0~rc1", "<<", "1.0~rc2"),
+    ("1.0-1~bpo1", "<<", "1.0-1"),
+    # Letters sort before other characters, and anything sorts after the end of a part
+    ("1.0", "<<", "1.0a"),
+    ("1.0a", "<<", "1.0+dfsg"),
+    ("1.0+dfsg", "<<", "1.0.1"),
+    ("1.0a", "<<", "1.0b"),
+    ("1.0Z", "<<", "1.0a"),
+    ("1.0-1", "<<", "1.0-1+b1"),
+    ("1.0-1", "<<", "1.0-1.1"),
+    # Digit parts compare numerically
+    ("1.9", "<<", "1.10"),
+    ("1.01", "=", "1.1"),
+    ("1.0.0", ">>", "1.0"),
+    # Epochs are compared first, and default to 0
+    ("1.0.1", "<<", "1:0.1"),
+    ("2:0", ">>", "1:9"),
+    ("0:1.0", "=", "1.0"),
+    # An empty Debian revision compares equal to "0"
+    ("1.0", "=", "1.0-0"),
+    ("1.0", "<<", "1.0-1"),
+    ("1.0-0", "<<", "1.0-0.1"),
+    # The Debian revision starts after the last hyphen
+    ("1.0-2-1", ">>", "1.0-1-2"),
+    ("1.0-1", "<<", "1.0-1-1"),
+    # The obsolete < and > mean <= and >=
+    ("1.0", "<", "1.0"),
+    ("1.0", ">", "1.0"),
+]
+
+def split_version(version):
+    """
+    Split a version into its epoch, upstream version and Debian revision.
+
+    Args:
+        version (str): The version, e.g. "1:2.34-0ubuntu3".
+
+    Returns:
+        tuple: (epoch, upstream_version, debian_revision), e.g. (1, "2.34", "0ubuntu3").
+    """
+
+    version = version.strip()
+
+    epoch = 0
+    if ":" in version:
+        epoch_part, version = version.split(":", 1)
+        epoch = int(epoch_part) if epoch_part.isdigit() else 0
+
+    upstream, revision = version, ""
+    if "-" in version:
+        upstream, revision = version.rsplit("-", 1)
+
+    return epoch, upstream, revision
+
+def char_order(char):
+    """
+    Sort weight of a character in a non-digit part: "~" first, then letters, then everything else.
+    """
+
+    if char == "~":
+        return -1
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+def compare_part(a, b):
+    """
+    Compare an upstream version or a Debian revision with dpkg's algorithm.
+
+    Returns:
+        int: A negative number if a < b, 0 if they are equal, a positive number if a > b.
+    """
+
+    i = j = 0
+
+    while i < len(a) or j < len(b):
+        # Non-digit parts, character by character (the end of a part weighs 0)
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            a_order = char_order(a[i]) if i < len(a) and not a[i].isdigit() else 0
+            b_order = char_order(b[j]) if j < len(b) and not b[j].isdigit() else 0
+            if a_order != b_order:
+                return a_order - b_order
+            i += 1
+            j += 1
+
+        # Digit parts, numerically
+        a_start, b_start = i, j
+        while i < len(a) and a[i].isdigit():
+            i += 1
+        while j < len(b) and b[j].isdigit():
+            j += 1
+        a_number = int(a[a_start:i] or 0)
+        b_number = int(b[b_start:j] or 0)
+        if a_number != b_number:
+            return -1 if a_number < b_number else 1
+
+    return 0
+
+def compare_versions(a, b):
+    """
+    Compare two Debian versions.
+
+    Args:
+        a (str): The first version.
+        b (str): The second version.
+
+    Returns:
+        int: A negative number if a < b, 0 if they are equal, a positive number if a > b.
+    """
+
+    a_epoch, a_upstream, a_revision = split_version(a)
+    b_epoch, b_upstream, b_revision = split_version(b)
+
+    if a_epoch != b_epoch:
+        return -1 if a_epoch < b_epoch else 1
+
+    return compare_part(a_upstream, b_upstream) or compare_part(a_revision, b_revision)
+
+def version_satisfies(version, relation, required):
+    """
+    Check a version against a relationship constraint, e.g. version_satisfies("2.36-9", ">=", "2.34").
+
+    Args:
+        version (str): The version of the package.
+        relation (str): One of <<, <=, =, >=, >> (or the obsolete < and >, meaning <= and >=).
+        required (str): The version in the constraint.
+
+    Returns:
+        bool: Whether the version satisfies the constraint.
+    """
+
+    return RELATIONS[relation](compare_versions(version, required), 0)
+
+def encode_number(digits):
+    # Numbers sort by length first (without leading zeros), then digit by digit
+    digits = digits.lstrip("0")
+    return chr(ord("a") + len(digits)) + digits
+
+def encode_char(order):
+    # Characters of non-digit parts, and the end of a part (order 0), as 3 hex digits
+    return format(min(order + 1, 0xfff), "03x")
+
+def encode_part(part):
+    """
+    Encode an upstream version or a Debian revision for version_key().
+    """
+
+    # An empty part compares equal to "0"
+    part = part or "0"
+
+    tokens = []
+    i = 0
+    while i < len(part):
+        while i < len(part) and not part[i].isdigit():
+            tokens.append(encode_char(char_order(part[i])))
+            i += 1
+        tokens.append(encode_char(0))
+
+        start = i
+        while i < len(part) and part[i].isdigit():
+            i += 1
+        tokens.append(encode_number(part[start:i]))
+
+    # The end of the version is an empty non-digit part
+    tokens.append(encode_char(0))
+    return "".join(tokens)
+
+def version_key(version):
+    """
+    Compute a sort key of a version: for any two versions a and b,
+    version_key(a) < version_key(b) exactly when compare_versions(a, b) < 0.
+
+    Args:
+        version (str): The version, e.g. "1:2.34-0ubuntu3".
+
+    Returns:
+        str: The sort key, an ASCII string.
+    """
+
+    epoch, upstream, revision = split_version(version)
+    return encode_number(str(epoch)) + encode_part(upstream) + encode_part(revision)
+
+def sign(number):
+    # -1, 0 or 1, the sign of a comparison result
+    return (number > 0) - (number < 0)
+
+def random_version(rng):
+    """
+    Generate a random version for check_consistency(), mostly digits and separators.
+    """
+
+    length = rng.randint(1, 8)
+    version = "".join(rng.choice("0012.~+a-z") for _ in range(length))
+    if rng.random() < 0.2:
+        version = str(rng.randint(0, 2)) + ":" + version
+    return version
+
+def check_consistency(versions=(), random_count=300, seed=0):
+    """
+    Check compare_versions() and version_key() against KNOWN_ORDERINGS and against each other.
+
+    Args:
+        versions (iterable): More versions to compare, pairwise, on top of those of KNOWN_ORDERINGS.
+        random_count (int): Number of random versions to add to them.
+        seed (int): Seed of the random versions, so failures can be reproduced.
+
+    Returns:
+        list: A description of each disagreement found, empty if there is none.
+    """
+
+    errors = []
+
+    for a, relation, b in KNOWN_ORDERINGS:
+        if not version_satisfies(a, relation, b):
+            errors.append(f"compare_versions: expected {a} {relation} {b}")
+        if not RELATIONS[relation](version_key(a), version_key(b)):
+            errors.append(f"version_key: expected {a} {relation} {b}")
+
+    rng = random.Random(seed)
+    versions = set(versions)
+    versions.update(version for a, _, b in KNOWN_ORDERINGS for version in (a, b))
+    versions.update(random_version(rng) for _ in range(random_count))
+    versions = sorted(versions)
+    keys = [version_key(version) for version in versions]
+
+    # The key order must agree with compare_versions() on every pair
+    for i, a in enumerate(versions):
+        for j in range(i + 1, len(versions)):
+            expected = sign(compare_versions(a, versions[j]))
+            if sign((keys[i] > keys[j]) - (keys[i] < keys[j])) != expected:
+                errors.append(f"version_key disagrees with compare_versions on {a} and {versions[j]}")
+            if sign(compare_versions(versions[j], a)) != -expected:
+                errors.append(f"compare_versions is not antisymmetric on {a} and {versions[j]}")
+
+    return errors
+
+if __name__ == "__main__":
+    errors = check_consistency()
+    for error in errors:
+        print(error, file=sys.stderr)
+    print(f"{len(errors)} version ordering errors")
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,249 @@
+# This module parses the relationship fields of Packages files (Depends, Pre-Depends,
+# Recommends...) and builds the dependency graph of a dataset.
+
+# A relationship field such as:
+#   Depends: libc6 (>= 2.34), default-mta | mail-transport-agent, python3:any
+# is a comma-separated list of groups, each group being a "|"-separated list of
+# alternatives. It is parsed into:
+#   [[{"name": "libc6", "arch": None, "relation": ">=", "version": "2.34"}],
+#    [{"name": "default-mta", ...}, {"name": "mail-transport-agent", ...}],
+#    [{"name": "python3", "arch": "any", "relation": None, "version": None}]]
+
+# From these records json_parser.py writes a forward index (package -> relationships)
+# and a reverse index (package -> packages that refer to it) next to each Packages.json,
+# which server.py uses to answer reverse-dependency and closure queries.
+
+import re
+from collections import deque
+
+RELATIONSHIP_FIELDS = ("Pre-Depends", "Depends", "Recommends", "Suggests", "Enhances",
+                       "Breaks", "Conflicts", "Replaces", "Provides")
+
+# Fields followed by default when computing what a package needs to be installed
+INSTALL_FIELDS = ("Pre-Depends", "Depends")
+
+# Upper bounds of graph traversals, so a single query cannot walk the whole repository forever
+MAX_DEPTH = 50
+MAX_NODES = 10000
+
+ALTERNATIVE_RE = re.compile(
+    r"^\s*(?P<name>[a-zA-Z0-9][a-zA-Z0-9+.\-]*)"
+    r"(?::(?P<arch>[a-zA-Z0-9\-]+))?"
+    r"\s*(?:\(\s*(?P<relation><<|<=|=|>=|>>|<|>)\s*(?P<version>[^)\s]+)\s*\))?"
+)
+
+def parse_relationship(value):
+    """
+    Parse the value of a relationship field.
+
+    Args:
+        value (str): The field value, e.g. "libc6 (>= 2.34), default-mta | mail-transport-agent".
+
+    Returns:
+        list: One list of alternatives per group, each alternative being a dict with
+              the keys name, arch, relation and version (None when not specified).
+    """
+
+    groups = []
+
+    for group in value.split(","):
+        # Architecture lists and build profiles only appear in source packages, drop them
+        group = re.sub(r"\[[^\]]*\]|<[!a-zA-Z][^<>]*>", "", group)
+
+        alternatives = []
+        for alternative in group.split("|"):
+            match = ALTERNATIVE_RE.match(alternative)
+            if match:
+                alternatives.append(match.groupdict())
+
+        if alternatives:
+            groups.append(alternatives)
+
+    return groups
+
+def parse_relationships(package):
+    """
+    Parse all the relationship fields of a package entry.
+
+    Args:
+        package (dict): A package entry, as produced by json_parser.parse_packages().
+
+    Returns:
+        dict: The parsed groups for each relationship field present in the package.
+    """
+
+    return {field: parse_relationship(package[field]) for field in RELATIONSHIP_FIELDS if package.get(field)}
+
+class DependencyGraph:
+    """
+    Forward and reverse dependency indexes of a dataset.
+
+    Attributes:
+        forward (dict): Package name -> relationship field -> groups of alternatives.
+        reverse (dict): Package name -> relationship field -> names of the packages referring to it.
+    """
+
+    def __init__(self, forward, reverse):
+        self.forward = forward
+        self.reverse = reverse
+
+    @classmethod
+    def from_packages(cls, packages):
+        """
+        Build the graph from package entries. When a name appears more than once, the first entry is used.
+        """
+
+        graph = cls({}, {})
+        for package in packages:
+            graph.add(package.get("Package"), parse_relationships(package))
+        return graph
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build the graph from the content of a Packages.deps.json file.
+        """
+
+        return cls(data["forward"], data["reverse"])
+
+    def to_dict(self):
+        """
+        Return the content of a Packages.deps.json file.
+        """
+
+        return {"forward": self.forward, "reverse": self.reverse}
+
+    def add(self, name, relationships):
+        """
+        Add the parsed relationships of a package to the forward and reverse indexes.
+        """
+
+        if name is None or name in self.forward:
+            return
+
+        self.forward[name] = relationships
+
+        for field, groups in relationships.items():
+            targets = {alternative["name"] for group in groups for alternative in group}
+            for target in sorted(targets):
+                self.reverse.setdefault(target, {}).setdefault(field, []).append(name)
+
+    def providers(self, name):
+        """
+        Return the packages that provide the given (possibly virtual) package name.
+        """
+
+        return self.reverse.get(name, {}).get("Provides", [])
+
+    def rdepends(self, name, fields=INSTALL_FIELDS, max_depth=1, max_nodes=MAX_NODES):
+        """
+        Find the packages that depend on a package, directly or (with max_depth > 1) transitively.
+
+        Packages depending on a virtual package provided by name are included as well.
+
+        Args:
+            name (str): The package name.
+            fields (tuple): The relationship fields to follow.
+            max_depth (int): How many levels of reverse dependencies to follow.
+            max_nodes (int): Maximum number of packages returned.
+
+        Returns:
+            tuple: A list of {"package", "field", "depth", "via"} dicts in breadth-first order,
+                   and whether the traversal was truncated by max_nodes.
+        """
+
+        results = []
+        seen = {name}
+        queue = deque([(name, 0)])
+
+        while queue:
+            current, depth = queue.popleft()
+            if depth >= max_depth:
+                continue
+
+            # A package is also required through the virtual packages it provides
+            targets = [current] + [provided["name"] for group in self.forward.get(current, {}).get("Provides", [])
+                                   for provided in group]
+
+            for target in targets:
+                for field in fields:
+                    for dependent in self.reverse.get(target, {}).get(field, []):
+                        if dependent in seen:
+                            continue
+                        if len(results) >= max_nodes:
+                            return results, True
+
+                        seen.add(dependent)
+                        results.append({"package": dependent, "field": field, "depth": depth + 1, "via": target})
+                        queue.append((dependent, depth + 1))
+
+        return results, False
+
+    def resolve(self, alternatives, satisfies=None):
+        """
+        Choose the package satisfying a group of alternatives: the first alternative available
+        in the dataset, either as a real package or through a package providing it.
+
+        Args:
+            alternatives (list): The alternatives of a group.
+            satisfies (callable): Optional check satisfies(package_name, alternative) -> bool,
+                                  used to skip real packages that don't match the alternative.
+
+        Returns:
+            str: The chosen package name, or None if no alternative is available.
+        """
+
+        for alternative in alternatives:
+            name = alternative["name"]
+            if name in self.forward and (satisfies is None or satisfies(name, alternative)):
+                return name
+            providers = self.providers(name)
+            if providers:
+                return providers[0]
+        return None
+
+    def closure(self, name, fields=INSTALL_FIELDS, max_depth=MAX_DEPTH, max_nodes=MAX_NODES, satisfies=None):
+        """
+        Compute the transitive dependencies of a package.
+
+        Args:
+            name (str): The package name.
+            fields (tuple): The relationship fields to follow.
+            max_depth (int): How many levels of dependencies to follow.
+            max_nodes (int): Maximum number of packages returned.
+            satisfies (callable): Optional version check, see resolve().
+
+        Returns:
+            dict: "closure", a list of {"package", "depth", "required_by"} dicts in breadth-first order,
+                  "missing", the groups that no package of the dataset satisfies, and
+                  "truncated", whether max_depth or max_nodes stopped the traversal.
+        """
+
+        closure = []
+        missing = []
+        truncated = False
+        seen = {name}
+        queue = deque([(name, 0)])
+
+        while queue:
+            current, depth = queue.popleft()
+            relationships = self.forward.get(current, {})
+
+            for field in fields:
+                for group in relationships.get(field, []):
+                    chosen = self.resolve(group, satisfies)
+                    if chosen is None:
+                        missing.append({"required_by": current, "field": field,
+                                        "alternatives": [alternative["name"] for alternative in group]})
+                        continue
+                    if chosen in seen:
+                        continue
+                    if depth >= max_depth or len(closure) >= max_nodes:
+                        truncated = True
+                        continue
+
+                    seen.add(chosen)
+                    closure.append({"package": chosen, "depth": depth + 1, "required_by": current})
+                    queue.append((chosen, depth + 1))
+
+        return {"closure": closure, "missing": missing, "truncated": truncated}
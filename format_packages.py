@@ -43,8 +43,8 @@ Filename: pool/main/0/0ad/0ad_0.0.26-3_amd64.deb
 # the Description and Tag attributes continue their description in multiple lines, 
 # making it difficult to standardize the conversion to JSON.
 
-# Therefore to simplify the JSON conversion, via regexes the spaces were removed
-# so that both Description and Tag remained on a single line:
+# Therefore to simplify the JSON conversion, the continuation lines of both
+# Description and Tag are folded so that they remain on a single line:
 
 """
 Package: 0ad
@@ -67,97 +67,218 @@ Filename: pool/main/0/0ad/0ad_0.0.26-3_amd64.deb
 """
 
 import os
-import re
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import logging
 from setup_logging import setup_logging
+from stanza_parser import fold_value, init_worker, read_files_from
+from instrumentation import increment, metrics, run_collecting, run_summary, span
+
+# The multi-line fields folded on a single line, every other line is copied unchanged
+FOLDED_FIELDS = ('Description', 'Tag')
 
 def format_description(description):
-    # Remove empty lines at the beginning and end of the Description
-    description = description.strip()
+    # Merge the description lines into a single line, one space between them
+    lines = description.strip().split('\n')
+    return fold_value('Description', lines[0].strip(), lines[1:])
 
-    # Merge description lines into a single text block
-    description = ''.join(description.split('\n'))
+def format_tag(tag):
+    # Remove leading and trailing whitespace, and extra spaces within the Tag
+    return ' '.join(tag.split())
 
-    return description
+def fold_field(first_line, continuation_lines, line_ending):
+    # A field written on a single line is kept as it is
+    if not continuation_lines:
+        return first_line
 
-def format_tag(tag):
-    # Remove leading and trailing whitespace from the Tag
-    tag = tag.strip()
+    # Otherwise it is rebuilt from its key, as written in the file, and its folded value
+    key_text, _, value = first_line.rstrip('\r\n').partition(':')
+    folded = fold_value(key_text.strip(), value.strip(), continuation_lines)
+    return f"{key_text}: {folded}{line_ending}" if folded else f"{key_text}:{line_ending}"
 
-    # Remove extra spaces within the Tag
-    tag = ' '.join(tag.split())
+def iter_formatted_lines(lines, folded_fields=FOLDED_FIELDS):
+    """
+    Fold the multi-line fields of a Packages file in a single pass over its lines.
 
-    return tag
+    Only the fields listed in folded_fields are rewritten; every other line, including the
+    blank lines between stanzas and the continuation lines of other fields, is yielded unchanged.
 
-def update_package_info(input_file_path, output_file_path):
-    logging.info(f"Processing file: {input_file_path}")
-    with open(input_file_path, 'r') as file:
-        # Read the entire content of the file
-        content = file.read()
+    Args:
+        lines (iterable): Lines of a Packages file, with their line endings.
+        folded_fields (tuple): Names of the fields to fold.
+
+    Yields:
+        str: The lines of the formatted file, with their line endings.
+    """
+
+    # The field being folded: [its first line, its continuation lines, the line ending of its last line]
+    pending = None
+
+    for line in lines:
+        text = line.rstrip('\r\n')
+        line_ending = line[len(text):]
+
+        # An indented, non-blank line continues the previous field
+        if text[:1] in (' ', '\t') and text.strip():
+            if pending is not None:
+                pending[1].append(text)
+                pending[2] = line_ending
+            else:
+                yield line
+            continue
+
+        if pending is not None:
+            yield fold_field(*pending)
+            pending = None
+
+        key_text, separator, _ = text.partition(':')
+        if separator and key_text.strip() in folded_fields:
+            pending = [line, [], line_ending]
+        else:
+            yield line
+
+    if pending is not None:
+        yield fold_field(*pending)
+
+def format_text(content, folded_fields=FOLDED_FIELDS):
+    """
+    Fold the multi-line fields of the content of a Packages file held in memory.
+
+    Args:
+        content (str): The content of a Packages file.
+        folded_fields (tuple): Names of the fields to fold.
+
+    Returns:
+        str: The formatted content.
+    """
+
+    return ''.join(iter_formatted_lines(content.splitlines(keepends=True), folded_fields))
 
-        # Find blocks related to each package
-        package_blocks = re.split(r'\n\n', content)
+def format_stream(input_file, output_file, progress=False):
+    """
+    Copy a Packages file from one open text file to another, folding its multi-line fields.
 
-        # Iterate over package blocks
-        for i, package_block in tqdm(enumerate(package_blocks), desc="Processing Packages", total=len(package_blocks)):
-            # Find the description in the package block
-            match_description = re.search(r'Description:(.*?)(?=\n\w|\Z)', package_block, re.DOTALL)
-            if match_description:
-                description = match_description.group(1).strip()
-                formatted_description = format_description(description)
+    Args:
+        input_file (file): A text file open for reading, preferably with newline=''.
+        output_file (file): A text file open for writing, preferably with newline=''.
+        progress (bool): Whether to show a progress bar of the lines read.
 
-                # Replace the old description with the formatted one
-                package_block = package_block.replace(description, formatted_description)
+    Returns:
+        int: The number of characters written.
+    """
 
-            # Find the tag in the package block
-            match_tag = re.search(r'Tag:(.*?)(?=\n\w|\Z)', package_block, re.DOTALL)
-            if match_tag:
-                tag = match_tag.group(1).strip()
-                formatted_tag = format_tag(tag)
+    written = 0
+    lines = tqdm(input_file, desc="Processing Packages", unit=" lines", disable=not progress)
+    for line in iter_formatted_lines(lines):
+        output_file.write(line)
+        written += len(line)
+    return written
 
-                # Replace the old tag with the formatted one
-                package_block = package_block.replace(tag, formatted_tag)
+def update_package_info(input_file_path, output_file_path=None, progress=True):
+    """
+    Format a Packages file, streaming it to a temporary file that atomically replaces the output.
 
-            # Update the package block in the content
-            package_blocks[i] = package_block
+    The output can be the input file itself: it is then rewritten in place, and readers see either
+    the old or the new content, never a partial file.
 
-        # Join the package blocks back together
-        updated_content = '\n\n'.join(package_blocks)
+    Args:
+        input_file_path (str): Path of the Packages file to format.
+        output_file_path (str): Path of the formatted file, or None to rewrite the input in place.
+        progress (bool): Whether to show a progress bar.
+    """
 
-    # Write the new content to the output file
-    with open(output_file_path, 'w') as file:
-        file.write(updated_content)
+    output_file_path = output_file_path or input_file_path
+    output_directory = os.path.dirname(output_file_path)
+    if output_directory:
+        os.makedirs(output_directory, exist_ok=True)
+
+    logging.info(f"Processing file: {input_file_path}")
+
+    increment("format_input_bytes_total", os.path.getsize(input_file_path))
+
+    tmp_path = f"{output_file_path}.tmp"
+    with span("format_file"):
+        try:
+            with open(input_file_path, 'r', encoding='utf-8', newline='') as input_file, \
+                    open(tmp_path, 'w', encoding='utf-8', newline='') as output_file:
+                format_stream(input_file, output_file, progress)
+            os.replace(tmp_path, output_file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    increment("format_files_total")
+    increment("format_output_bytes_total", os.path.getsize(output_file_path))
+
+def format_all_packages(input_dir, output_dir=None, only_files=None, workers=1):
+    # Without an output directory, the files are rewritten in place
+    output_dir = output_dir or input_dir
+
+    # (input, output) pairs of the files to format
+    file_pairs = []
 
-def format_all_packages(input_dir, output_dir):
     # Iterate over all files in the input directory and its subdirectories
     for root, _, files in os.walk(input_dir):
         for filename in files:
-            if filename.startswith("Packages"):
+            # Only the Packages files themselves, not Packages.json or leftover temporary files
+            if filename.endswith("Packages"):
                 input_file_path = os.path.join(root, filename)
+
+                # Skip files that are not in the list of files to process, if one was given
+                if only_files is not None and os.path.abspath(input_file_path) not in only_files:
+                    continue
+
                 # Output directory structure should mirror the input directory structure
                 relative_path = os.path.relpath(input_file_path, input_dir)
                 output_file_path = os.path.join(output_dir, relative_path)
 
-                # Log to check which file is being processed
-                logging.info(f"Processing file: {input_file_path}")
+                file_pairs.append((input_file_path, output_file_path))
+
+    # Sort the files so that the processing order (and the log) doesn't depend on os.walk
+    file_pairs.sort()
+
+    if workers <= 1 or len(file_pairs) <= 1:
+        for input_file_path, output_file_path in file_pairs:
+            # Perform description and tag updates, and save the result to a new file
+            update_package_info(input_file_path, output_file_path)
+        return
+
+    # Fan the files out over a pool of processes, the work is CPU-bound
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        # Per-file progress bars of concurrent workers would overwrite each other, only the overall one is shown
+        futures = [executor.submit(run_collecting, update_package_info, input_file_path, output_file_path, False)
+                   for input_file_path, output_file_path in file_pairs]
+
+        for _ in tqdm(as_completed(futures), desc="Formatting Packages files", total=len(futures), unit="file"):
+            pass
+
+        # Log in input order and re-raise the first error, if any
+        for (input_file_path, output_file_path), future in zip(file_pairs, futures):
+            _, worker_metrics = future.result()
+            metrics.merge(worker_metrics)
+            logging.info(f"Formatted {input_file_path} into {output_file_path}")
 
-                # Perform description and tag updates, and save the result to a new file
-                update_package_info(input_file_path, output_file_path)
-                
 def main():
     # Set up command-line argument parsing
     parser = argparse.ArgumentParser(description="Format Parrot/Debian Packages files in a specified directory.")
     parser.add_argument("input_directory", help="Specify the input directory containing Packages files.")
-    parser.add_argument("output_directory", help="Specify the output directory for processed Packages files.")
+    parser.add_argument("output_directory", nargs="?", help="Specify the output directory for processed Packages files.")
+    parser.add_argument("--in-place", action="store_true", help="Rewrite the Packages files in place, atomically, instead of writing them to an output directory.")
+    parser.add_argument("--files-from", help="Only process the Packages files listed in this file, one per line.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used to format Packages files in parallel.")
 
     # Parse command-line arguments
     args = parser.parse_args()
+    if bool(args.output_directory) == args.in_place:
+        parser.error("specify either an output directory or --in-place")
 
     # Perform formatting for all Packages files in the specified directory
-    format_all_packages(args.input_directory, args.output_directory)
+    only_files = read_files_from(args.files_from) if args.files_from else None
+    format_all_packages(args.input_directory, None if args.in_place else args.output_directory, only_files, args.workers)
 
 if __name__ == "__main__":
     setup_logging('format_packages.log')
-    main()
+    with run_summary('format_packages'):
+        main()
@@ -0,0 +1,200 @@
+# This script generates synthetic Parrot/Debian Packages files for benchmarks.
+
+# The stanzas look like the real ones: a multi-line Description with paragraphs,
+# a Tag field wrapped over several lines, long Depends fields with version
+# constraints and alternatives, checksums and a pool Filename. The output only
+# depends on the options and the seed, so two runs produce identical files and
+# benchmark results can be compared over time.
+
+import argparse
+import gzip
+import hashlib
+import logging
+import lzma
+import random
+from setup_logging import setup_logging
+
+SYLLABLES = ("lib", "gtk", "qt", "py", "ssl", "xml", "net", "core", "data", "utils", "dev", "doc",
+             "fonts", "game", "audio", "video", "crypt", "db", "tools", "common", "perl", "ruby")
+
+WORDS = ("the", "a", "library", "program", "provides", "support", "for", "files", "network", "data",
+         "package", "contains", "development", "headers", "this", "graphical", "interface", "with",
+         "fast", "free", "open-source", "cross-platform", "tool", "server", "client", "plugin",
+         "documentation", "runtime", "shared", "implementation", "protocol", "format", "and", "of")
+
+TAGS = ("role::program", "role::shared-lib", "role::devel-lib", "role::documentation", "interface::graphical",
+        "interface::commandline", "interface::x11", "implemented-in::c", "implemented-in::c++",
+        "implemented-in::python", "game::strategy", "use::gameplaying", "uitoolkit::gtk", "uitoolkit::qt",
+        "works-with::text", "works-with::image", "network::client", "network::server", "scope::utility",
+        "suite::gnome", "suite::kde", "admin::configuring", "security::cryptography", "x11::application")
+
+SECTIONS = ("admin", "devel", "doc", "games", "graphics", "libs", "net", "python", "sound", "utils", "web", "x11")
+PRIORITIES = ("optional", "optional", "optional", "standard", "important", "required", "extra")
+RELATIONS = (">=", ">=", ">=", "<<", "=", "<=", ">>")
+
+def generate_name(rng, index):
+    """
+    Return a unique, realistic-looking package name.
+    """
+
+    return f"{''.join(rng.sample(SYLLABLES, rng.randint(1, 3)))}{index}"
+
+def generate_version(rng):
+    """
+    Return a version with the usual Debian decorations (epochs, ~rc, +dfsg, +debNuM).
+    """
+
+    version = ".".join(str(rng.randint(0, 40)) for _ in range(rng.randint(1, 4)))
+    if rng.random() < 0.1:
+        version = f"{rng.randint(1, 3)}:{version}"
+    if rng.random() < 0.1:
+        version += f"~rc{rng.randint(1, 5)}"
+    if rng.random() < 0.2:
+        version += "+dfsg"
+    version += f"-{rng.randint(1, 9)}"
+    if rng.random() < 0.15:
+        version += f"+deb12u{rng.randint(1, 4)}"
+    return version
+
+def generate_sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+def generate_relationship(rng, names, count):
+    """
+    Return a relationship field value referring to count previously generated packages.
+    """
+
+    groups = []
+    targets = rng.sample(names, min(count * 2, len(names)))
+    while targets:
+        alternatives = []
+        for _ in range(1 if rng.random() < 0.9 or len(targets) < 2 else 2):
+            alternative = targets.pop()
+            if rng.random() < 0.6:
+                alternative += f" ({rng.choice(RELATIONS)} {generate_version(rng)})"
+            alternatives.append(alternative)
+        groups.append(" | ".join(alternatives))
+        if len(groups) >= count:
+            break
+    return ", ".join(groups)
+
+def generate_stanza(rng, index, names, description_lines, tag_count, depends_count):
+    """
+    Generate the text of one package stanza.
+
+    Args:
+        rng (random.Random): The random generator.
+        index (int): Index of the package, used to make its name unique.
+        names (list): Names of the packages generated so far, referred to by Depends.
+        description_lines (int): Number of lines of the long description.
+        tag_count (int): Number of debtags.
+        depends_count (int): Number of Depends groups.
+
+    Returns:
+        tuple: The name of the package and the stanza text, ending with a newline.
+    """
+
+    name = generate_name(rng, index)
+    version = generate_version(rng)
+    architecture = "all" if rng.random() < 0.2 else "amd64"
+    section = rng.choice(SECTIONS)
+    size = rng.randint(1000, 50000000)
+    digest = hashlib.sha256(f"{name}_{version}".encode("utf-8"))
+
+    lines = [
+        f"Package: {name}",
+        f"Version: {version}",
+        f"Installed-Size: {size // 700}",
+        f"Maintainer: Debian {section.capitalize()} Team <pkg-{section}-devel@lists.alioth.debian.org>",
+        f"Architecture: {architecture}",
+    ]
+    if names and depends_count:
+        lines.append(f"Depends: {generate_relationship(rng, names, rng.randint(1, depends_count))}")
+    if names and rng.random() < 0.3:
+        lines.append(f"Recommends: {generate_relationship(rng, names, rng.randint(1, 3))}")
+    if rng.random() < 0.05:
+        lines.append("Pre-Depends: dpkg (>= 1.15.6~)")
+    lines += [
+        f"Size: {size}",
+        f"SHA256: {digest.hexdigest()}",
+        f"MD5sum: {hashlib.md5(digest.digest()).hexdigest()}",
+        f"Description: {generate_sentence(rng, rng.randint(3, 9))}",
+    ]
+
+    # Long description: lines start with a space, paragraphs are separated by " ."
+    for line in range(description_lines):
+        if line and line % 5 == 0:
+            lines.append(" .")
+        lines.append(" " + generate_sentence(rng, rng.randint(8, 13)))
+
+    lines.append(f"Homepage: https://{name}.example.org/")
+
+    if tag_count:
+        # Tags are wrapped a few per line, like in the real files
+        tags = sorted(rng.sample(TAGS, min(tag_count, len(TAGS))))
+        chunks = [", ".join(tags[start:start + 3]) for start in range(0, len(tags), 3)]
+        lines.append("Tag: " + ",\n ".join(chunks))
+
+    lines += [
+        f"Section: {section}",
+        f"Priority: {rng.choice(PRIORITIES)}",
+        f"Filename: pool/main/{name[0]}/{name}/{name}_{version.split(':')[-1]}_{architecture}.deb",
+    ]
+
+    return name, "\n".join(lines) + "\n"
+
+def generate_packages(output_path, count, description_lines=6, tag_count=6, depends_count=12, seed=0):
+    """
+    Write a synthetic Packages file, compressed if the path ends with .xz or .gz.
+
+    Args:
+        output_path (str): Path of the file to write.
+        count (int): Number of stanzas.
+        description_lines (int): Number of lines of each long description.
+        tag_count (int): Number of debtags of each package.
+        depends_count (int): Maximum number of Depends groups of each package.
+        seed (int): Seed of the random generator, the same seed gives the same file.
+
+    Returns:
+        int: The size of the uncompressed content, in bytes.
+    """
+
+    rng = random.Random(seed)
+    names = []
+    total_size = 0
+
+    if output_path.endswith(".xz"):
+        file = lzma.open(output_path, "wt", encoding="utf-8")
+    elif output_path.endswith(".gz"):
+        file = gzip.open(output_path, "wt", encoding="utf-8")
+    else:
+        file = open(output_path, "w", encoding="utf-8")
+
+    with file:
+        for index in range(count):
+            name, stanza = generate_stanza(rng, index, names, description_lines, tag_count, depends_count)
+            if index:
+                file.write("\n")
+                total_size += 1
+            file.write(stanza)
+            total_size += len(stanza.encode("utf-8"))
+            names.append(name)
+
+    return total_size
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Packages file for benchmarks.")
+    parser.add_argument("output_path", help="Path of the Packages file to write (.xz and .gz are compressed).")
+    parser.add_argument("--count", type=int, default=10000, help="Number of package stanzas.")
+    parser.add_argument("--description-lines", type=int, default=6, help="Number of lines of each long description.")
+    parser.add_argument("--tags", type=int, default=6, help="Number of debtags of each package.")
+    parser.add_argument("--depends", type=int, default=12, help="Maximum number of Depends groups of each package.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator.")
+    args = parser.parse_args()
+
+    size = generate_packages(args.output_path, args.count, args.description_lines, args.tags, args.depends, args.seed)
+    logging.info(f"Generated {args.count} packages ({size} bytes) in {args.output_path}")
+
+if __name__ == "__main__":
+    setup_logging('generate_packages.log')
+    main()
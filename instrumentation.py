@@ -0,0 +1,355 @@
+# This module collects the metrics of the scripts and of the server: counters,
+# gauges, histograms and timing spans, kept in memory by a process-wide registry.
+
+# Every script saves what it measured as a JSON run summary when it exits
+# (tmp/runs/<script>-<UTC time>-<pid>.json, never overwritten by the next run), and
+# server.py exposes the same registry in the Prometheus text format at /metrics.
+
+# Worker processes have their own registry: functions run in a worker with
+# run_collecting() send back what they recorded, and the parent merges it.
+# Server worker processes, which have no parent to report to, save their
+# registry in a shared directory every second instead (share_metrics()), and
+# /metrics adds up what all of them saved (collect_shared_metrics()).
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Prefix of the metric names exposed to Prometheus
+METRIC_PREFIX = "repo_"
+
+# Environment variable naming the directory where server worker processes share their metrics
+SHARED_METRICS_VARIABLE = "REPO_SHARED_METRICS"
+
+# Interval between two saves of the metrics of a server worker process, in seconds
+SHARE_INTERVAL = 1.0
+
+# Upper bounds of the histogram buckets of durations, in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Histogram:
+    """
+    Counts of observed values per bucket, with their count, sum, minimum and maximum.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One count per bucket, plus the values above the last bound (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "count": self.count,
+                "sum": self.sum, "min": self.min, "max": self.max}
+
+    def merge(self, data):
+        if tuple(data["buckets"]) != self.buckets:
+            raise ValueError("Cannot merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, data["counts"])]
+        self.count += data["count"]
+        self.sum += data["sum"]
+        for bound, pick in (("min", min), ("max", max)):
+            if data[bound] is not None:
+                current = getattr(self, bound)
+                setattr(self, bound, data[bound] if current is None else pick(current, data[bound]))
+
+def label_key(labels):
+    # Labels are part of the identity of a metric, in a stable order
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+class MetricsRegistry:
+    """
+    A thread-safe set of counters, gauges and histograms, each identified by a name and labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every metric recorded so far.
+        """
+
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        """
+        Add a value to a counter, e.g. increment("download_bytes_total", len(chunk)).
+        """
+
+        key = (name, label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Set the current value of a gauge, e.g. set_gauge("datasets_loaded", 4).
+        """
+
+        with self._lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        """
+        Record a value in a histogram, e.g. a duration in seconds.
+        """
+
+        key = (name, label_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def span(self, name, **labels):
+        """
+        Time a block of code and record its duration in the histogram <name>_seconds.
+
+        Example:
+            with metrics.span("parse_file", format="json"):
+                ...
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        Return every metric as JSON-serializable data, see merge().
+        """
+
+        with self._lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [{"name": name, "labels": dict(labels), **histogram.to_dict()}
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def merge(self, snapshot):
+        """
+        Add the metrics of a snapshot taken in another process: counters and histograms are summed,
+        gauges are replaced.
+        """
+
+        for counter in snapshot["counters"]:
+            self.increment(counter["name"], counter["value"], **counter["labels"])
+        for gauge in snapshot["gauges"]:
+            self.set_gauge(gauge["name"], gauge["value"], **gauge["labels"])
+        with self._lock:
+            for data in snapshot["histograms"]:
+                key = (data["name"], label_key(data["labels"]))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(data["buckets"])
+                histogram.merge(data)
+
+    def render_prometheus(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+
+        lines = []
+        snapshot = self.snapshot()
+
+        for kind, metric_type in (("counters", "counter"), ("gauges", "gauge")):
+            declared = set()
+            for metric in snapshot[kind]:
+                name = METRIC_PREFIX + metric["name"]
+                if name not in declared:
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    declared.add(name)
+                lines.append(f"{name}{format_labels(metric['labels'])} {metric['value']}")
+
+        declared = set()
+        for histogram in snapshot["histograms"]:
+            name = METRIC_PREFIX + histogram["name"]
+            if name not in declared:
+                lines.append(f"# TYPE {name} histogram")
+                declared.add(name)
+
+            cumulative = 0
+            for bound, count in zip(list(histogram["buckets"]) + ["+Inf"], histogram["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels({**histogram['labels'], 'le': bound})} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{name}_count{format_labels(histogram['labels'])} {histogram['count']}")
+
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+# The registry of the current process, and shortcuts to it
+metrics = MetricsRegistry()
+increment = metrics.increment
+set_gauge = metrics.set_gauge
+observe = metrics.observe
+span = metrics.span
+
+def run_collecting(function, *args):
+    """
+    Call a function in a worker process and return its result with the metrics it recorded.
+
+    Returns:
+        tuple: The result of the function, and a snapshot to pass to metrics.merge() in the parent.
+    """
+
+    metrics.reset()
+    result = function(*args)
+    return result, metrics.snapshot()
+
+def write_shared_metrics(directory, previous=None):
+    """
+    Save the metrics of this process in a shared directory, as <pid>.json.
+
+    Args:
+        directory (str): The shared directory.
+        previous (str): What the previous call saved, nothing is written if it did not change.
+
+    Returns:
+        str: The content saved.
+    """
+
+    content = json.dumps(metrics.snapshot())
+    if content != previous:
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+            file.write(content)
+        os.replace(f"{path}.tmp", path)
+    return content
+
+def share_metrics(directory, interval=SHARE_INTERVAL):
+    """
+    Save the metrics of this process in a shared directory every interval seconds, in a background thread.
+
+    Returns:
+        threading.Event: Set it to save the metrics a last time and stop.
+    """
+
+    stop = threading.Event()
+
+    def save():
+        previous = None
+        while not stop.wait(interval):
+            previous = write_shared_metrics(directory, previous)
+        write_shared_metrics(directory, previous)
+
+    threading.Thread(target=save, name="share-metrics", daemon=True).start()
+    return stop
+
+def collect_shared_metrics(directory):
+    """
+    Add up the metrics saved by every process sharing a directory, this one included.
+
+    Counters and histograms are summed, gauges get a "worker" label with the process id,
+    since adding them up would not make sense (e.g. datasets_loaded).
+
+    Returns:
+        MetricsRegistry: A registry holding the metrics of all the processes.
+    """
+
+    write_shared_metrics(directory)
+
+    registry = MetricsRegistry()
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+        for gauge in snapshot["gauges"]:
+            gauge["labels"] = {**gauge["labels"], "worker": filename[:-len('.json')]}
+        registry.merge(snapshot)
+    return registry
+
+def shared_metrics_directory():
+    # Next to the logs written by setup_logging()
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp', 'metrics')
+
+def runs_directory():
+    # Next to the logs written by setup_logging()
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp', 'runs')
+
+def write_run_summary(script_name, started, status):
+    """
+    Save the metrics of a run as a JSON summary.
+
+    Args:
+        script_name (str): Name of the script, e.g. "json_parser".
+        started (float): Start time of the run, as returned by time.time().
+        status (str): "ok", or "failed" if the run raised an exception.
+
+    Returns:
+        str: Path of the summary.
+    """
+
+    finished = time.time()
+    summary = {
+        "script": script_name,
+        "argv": sys.argv[1:],
+        "status": status,
+        "started": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)),
+        "finished": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(finished)),
+        "duration_seconds": round(finished - started, 3),
+        "metrics": metrics.snapshot(),
+    }
+
+    directory = runs_directory()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{script_name}-{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(started))}-{os.getpid()}.json")
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(summary, file, indent=2)
+    return path
+
+@contextmanager
+def run_summary(script_name):
+    """
+    Save the run summary of a script when the block exits, even if it fails.
+
+    Example:
+        with run_summary("json_parser"):
+            main()
+    """
+
+    started = time.time()
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    except SystemExit as exit:
+        # e.g. argparse exiting after --help
+        status = "ok" if exit.code in (None, 0) else "failed"
+        raise
+    finally:
+        logging.info(f"Run summary saved to {write_run_summary(script_name, started, status)}")
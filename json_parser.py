@@ -6,13 +6,45 @@
 # maintaining the directory structure of the input. 
 
 import os
-import re
 import json
 import argparse
 import logging
+import time
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from setup_logging import setup_logging
+from instrumentation import increment, metrics, run_collecting, run_summary, set_gauge, span
+from stanza_parser import init_worker, iter_stanzas, open_packages, read_files_from
+from dependencies import DependencyGraph, parse_relationships
+from sqlite_snapshot import SnapshotWriter
+from snapshot_diff import collect_fingerprint, commit_fingerprints, stage_fingerprint, write_changeset
 from tqdm import tqdm 
 
+# Output formats: pretty-printed JSON, and/or a SQLite snapshot that server.py can query without loading it
+OUTPUT_FORMATS = ('json', 'sqlite')
+
+def iter_packages(lines):
+    """
+    Parse the lines of a Packages file and yield one package entry at a time.
+
+    Multi-line fields such as Description and Tag are folded on a single line while parsing,
+    so the file does not need to be formatted with format_packages.py first.
+
+    Args:
+        lines (iterable): Lines of the Packages file (e.g. an open file object).
+
+    Yields:
+        dict: A parsed package entry, with a sequential 'id' starting from 1.
+    """
+
+    current_id = 1
+
+    for stanza in iter_stanzas(lines):
+        package = {'id': current_id}
+        package.update(stanza)
+        yield package
+        current_id += 1
+
 def parse_packages(package_content):
     """
     Parse the content of a Packages file and extract information for each package entry.
@@ -23,65 +55,80 @@ def parse_packages(package_content):
     Returns:
         list: A list of dictionaries, each representing a parsed package entry.
     """
-    
-    packages = []
-    current_package = {}
-    current_id = 1
 
-    # Split the file content into individual packages
-    package_entries = re.split(r'\n\n', package_content.strip())
+    return list(iter_packages(package_content.splitlines()))
+
+def write_json_array(records, json_file):
+    """
+    Write records as a JSON array one element at a time.
+
+    The output is identical to json.dumps(list(records), indent=2), without holding the list in memory.
 
-    for entry in package_entries:
-        lines = entry.strip().split('\n')
+    Args:
+        records (iterable): The records to write.
+        json_file (file): A text file open for writing.
 
-        for line in lines:
-            # Split each line into key and value
-            parts = line.split(': ', 1)
-            if len(parts) == 2:
-                key, value = map(str.strip, parts)
-            else:
-                key, value = parts[0].strip(), ""
+    Returns:
+        int: The number of records written.
+    """
 
-            # Check for the start of a new package entry
-            if key == 'Package':
-                if current_package:
-                    current_package['id'] = current_id
-                    packages.append(current_package)
-                    current_id += 1
-                current_package = {'id': current_id}
+    count = 0
 
-            # Handle multi-line fields
-            if key in current_package:
-                current_package[key] += '\n' + value
-            else:
-                current_package[key] = value
+    for record in records:
+        json_file.write('[\n' if count == 0 else ',\n')
+        json_file.write('\n'.join('  ' + line for line in json.dumps(record, indent=2).split('\n')))
+        count += 1
 
-    if current_package:
-        current_package['id'] = current_id
-        packages.append(current_package)
+    json_file.write('\n]' if count else '[]')
 
-    return packages
+    return count
 
-def process_packages_file(input_path, output_directory, input_directory, recursive):
+def collect_dependencies(packages, graph):
     """
-    Process a Packages file, parse its content, and save the extracted information as JSON.
+    Add the relationships of each package to a dependency graph as the packages stream by.
 
     Args:
-        input_path (str): Path to the Packages file to be processed.
-        output_directory (str): Path to the directory for saving JSON outputs.
-        input_directory (str): Path to the root directory containing Packages files.
-        recursive (bool): Whether to recursively process subdirectories.
+        packages (iterable): Parsed package entries.
+        graph (DependencyGraph): The graph to fill.
+
+    Yields:
+        dict: The package entries, unchanged.
+    """
+
+    for package in packages:
+        graph.add(package.get('Package'), parse_relationships(package))
+        yield package
+
+def write_json_file(data, output_path):
+    """
+    Atomically write compact JSON data to a file.
+    """
+
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as json_file:
+        json.dump(data, json_file, separators=(',', ':'))
+    os.replace(tmp_path, output_path)
+
+def add_to_snapshot(packages, snapshot):
     """
-    
-    # Read the content of the Packages file
-    with open(input_path, 'r', encoding='utf-8') as file:
-        packages_content = file.read()
+    Add each package to a SQLite snapshot as the packages stream by.
 
-    # Parse the Packages content
-    parsed_packages = parse_packages(packages_content)
+    Args:
+        packages (iterable): Parsed package entries.
+        snapshot (SnapshotWriter): The snapshot being written.
+
+    Yields:
+        dict: The package entries, unchanged.
+    """
+
+    for package in packages:
+        snapshot.add(package)
+        yield package
 
-    # Convert the parsed data to JSON
-    json_data = json.dumps(parsed_packages, indent=2)
+def output_base_path(input_path, output_directory, input_directory, recursive):
+    """
+    Return the path of the outputs of a Packages file, without extension (e.g. output/main/binary-amd64/Packages).
+    """
 
     # Determine the output path based on the input path
     relative_input_path = os.path.relpath(input_path, input_directory)
@@ -91,20 +138,227 @@ def process_packages_file(input_path, output_directory, input_directory, recursi
     else:
         output_path = os.path.join(output_directory, os.path.basename(input_path))
 
-    output_path = os.path.splitext(output_path)[0] + '.json'
+    return os.path.splitext(output_path)[0]
+
+def process_packages_file(input_path, output_directory, input_directory, recursive, formats=('json',)):
+    """
+    Process a Packages file, parse its content, and save the extracted information as JSON
+    and/or as a SQLite snapshot (Packages.sqlite).
+
+    A fingerprint of the packages is saved as well, and compared with the one of the previous
+    run (Packages.fingerprint.json) to find the packages that changed. It only replaces the
+    previous one once the changes are saved, see save_changes().
+
+    The file is read, parsed and written in a single streaming pass, so memory use does not
+    depend on its size. The JSON is written to a temporary file and renamed into place once complete.
+    The forward and reverse dependency indexes of the packages are saved next to it, in Packages.deps.json.
+
+    Args:
+        input_path (str): Path to the Packages file to be processed.
+        output_directory (str): Path to the directory for saving JSON outputs.
+        input_directory (str): Path to the root directory containing Packages files.
+        recursive (bool): Whether to recursively process subdirectories.
+        formats (tuple): The output formats to write, among OUTPUT_FORMATS.
+
+    Returns:
+        tuple: The paths of the outputs, the number of packages written to them, and the changes
+               since the previous run (None if the file was never processed before).
+    """
+
+    base_path = output_base_path(input_path, output_directory, input_directory, recursive)
+    output_path = base_path + '.json'
+    snapshot_path = base_path + '.sqlite'
 
-    # Save the JSON data to a file
+    # Parse the Packages file and save the data as it is produced, in every requested format
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with open(output_path, 'w', encoding='utf-8') as json_file:
-        json_file.write(json_data)
+    graph = DependencyGraph({}, {})
+    fingerprint = {}
+    tmp_path = f"{output_path}.tmp"
+    with span("parse_file"), ExitStack() as stack:
+        packages = iter_packages(stack.enter_context(open_packages(input_path)))
+        packages = collect_fingerprint(packages, fingerprint)
+
+        if 'sqlite' in formats:
+            packages = add_to_snapshot(packages, stack.enter_context(SnapshotWriter(snapshot_path)))
+
+        packages = collect_dependencies(packages, graph)
+
+        if 'json' in formats:
+            json_file = stack.enter_context(open(tmp_path, 'w', encoding='utf-8'))
+            count = write_json_array(packages, json_file)
+        else:
+            count = sum(1 for _ in packages)
 
-    logging.info(f"JSON data saved to {output_path}")
+    output_paths = []
+
+    if 'json' in formats:
+        os.replace(tmp_path, output_path)
+        output_paths.append(output_path)
+
+    if 'sqlite' in formats:
+        output_paths.append(snapshot_path)
+
+    # The dependency indexes are published last: readers only trust them when they are newer than the packages
+    write_json_file(graph.to_dict(), base_path + '.deps.json')
+
+    changes = stage_fingerprint(fingerprint_path(base_path), fingerprint)
+
+    increment("packages_parsed_total", count)
+    increment("input_bytes_total", os.path.getsize(input_path))
+    for path in output_paths:
+        increment("output_bytes_total", os.path.getsize(path), format=os.path.splitext(path)[1][1:])
+
+    return output_paths, count, changes
+
+def fingerprint_path(base_path):
+    """
+    Return the path of the fingerprint of a dataset, from the path of its outputs without extension.
+    """
+
+    return base_path + '.fingerprint.json'
+
+def find_packages_files(input_directory, only_files=None):
+    """
+    Find the Packages files to process in a directory and its subdirectories.
+
+    Args:
+        input_directory (str): Path to the root directory containing Packages files.
+        only_files (set): Absolute paths of the only files to process, or None to process all of them.
+
+    Returns:
+        list: Paths of the Packages files, sorted so that processing order is deterministic.
+    """
+
+    input_paths = []
+
+    for root, _, files in os.walk(input_directory):
+        for filename in files:
+            if filename.endswith('Packages'):
+                input_path = os.path.join(root, filename)
+
+                # Skip files that did not change, if a list of files to process was given
+                if only_files is not None and os.path.abspath(input_path) not in only_files:
+                    continue
+
+                input_paths.append(input_path)
+
+    return sorted(input_paths)
+
+def process_all_packages(input_paths, output_directory, input_directory, recursive, workers=1, formats=('json',)):
+    """
+    Process several Packages files, optionally spreading them over a pool of worker processes.
+
+    Args:
+        input_paths (list): Paths to the Packages files to be processed.
+        output_directory (str): Path to the directory for saving JSON outputs.
+        input_directory (str): Path to the root directory containing Packages files.
+        recursive (bool): Whether to recursively process subdirectories.
+        workers (int): Number of worker processes, 1 processes the files in the current process.
+        formats (tuple): The output formats to write, among OUTPUT_FORMATS.
+
+    Returns:
+        list: One (input_path, output_paths, count, changes) tuple per file, in the order of input_paths.
+
+    Raises:
+        ValueError: If several files would be written to the same outputs (e.g. without --recursive).
+    """
+
+    # Files sharing outputs would overwrite each other's, and collide when processed in parallel
+    outputs = {}
+    for input_path in input_paths:
+        outputs.setdefault(output_base_path(input_path, output_directory, input_directory, recursive), []).append(input_path)
+    collisions = [paths for paths in outputs.values() if len(paths) > 1]
+    if collisions:
+        raise ValueError(f"Several Packages files would be saved to the same outputs, use --recursive: {', '.join(collisions[0])}")
+
+    results = []
+    start = time.perf_counter()
+
+    with tqdm(total=len(input_paths), desc="Processing Packages files", unit="file") as pbar:
+        if workers <= 1 or len(input_paths) <= 1:
+            for input_path in input_paths:
+                logging.info(f"Processing file: {input_path}")
+                output_paths, count, changes = process_packages_file(input_path, output_directory, input_directory, recursive, formats)
+                logging.info(f"Data saved to {', '.join(output_paths)} ({count} packages)")
+                results.append((input_path, output_paths, count, changes))
+                pbar.update(1)
+            record_throughput(results, time.perf_counter() - start)
+            return results
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            # Each worker sends back the metrics it recorded with its result
+            futures = [
+                executor.submit(run_collecting, process_packages_file, input_path, output_directory, input_directory, recursive, formats)
+                for input_path in input_paths
+            ]
+
+            # Progress follows completion order...
+            for _ in as_completed(futures):
+                pbar.update(1)
+
+            # ...while results and logs follow input order, whatever the order the workers finished in
+            for input_path, future in zip(input_paths, futures):
+                (output_paths, count, changes), worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+                logging.info(f"Data saved to {', '.join(output_paths)} ({count} packages)")
+                results.append((input_path, output_paths, count, changes))
+
+    record_throughput(results, time.perf_counter() - start)
+    return results
+
+def record_throughput(results, seconds):
+    """
+    Record how many packages were parsed per second over a whole run.
+    """
+
+    count = sum(result[2] for result in results)
+    if seconds > 0:
+        set_gauge("packages_per_second", round(count / seconds, 1))
+        logging.info(f"Parsed {count} packages in {seconds:.2f}s ({count / seconds:.0f} packages/s)")
+
+def save_changes(results, output_directory, changes_directory):
+    """
+    Save the changes found while processing Packages files as a new changeset,
+    then replace the previous fingerprints of the datasets with the new ones.
+
+    Until then, the previous fingerprints are kept: if the run fails before its changes are
+    saved, the next run finds them again.
+
+    Args:
+        results (list): The results of process_all_packages().
+        output_directory (str): Path to the directory of the JSON outputs.
+        changes_directory (str): Path to the directory where changesets are saved.
+
+    Returns:
+        str: The id of the new snapshot, or None if nothing changed.
+    """
+
+    datasets = {}
+    for _, output_paths, _, changes in results:
+        if changes is None or any(changes.values()):
+            # Datasets are identified by their directory, e.g. "main/binary-amd64"
+            dataset = os.path.relpath(os.path.dirname(output_paths[0]), output_directory)
+            datasets[dataset.replace(os.sep, '/')] = changes
+
+    snapshot_id = None
+    if datasets:
+        snapshot_id = write_changeset(changes_directory, datasets)
+        logging.info(f"Changes of {len(datasets)} datasets saved as snapshot {snapshot_id}")
+    else:
+        logging.info("No package changed since the previous run")
+
+    commit_fingerprints(fingerprint_path(os.path.splitext(output_paths[0])[0]) for _, output_paths, _, _ in results)
+    return snapshot_id
 
 def main():
     parser = argparse.ArgumentParser(description="Parse multiple Packages files and save JSON outputs.")
     parser.add_argument("input_directory", help="Path to the root directory containing Packages files.")
     parser.add_argument("output_directory", help="Path to the directory for saving JSON outputs.")
     parser.add_argument("--recursive", action="store_true", help="Recursively process subdirectories.")
+    parser.add_argument("--files-from", help="Only process the Packages files listed in this file, one per line.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used to parse Packages files in parallel.")
+    parser.add_argument("--format", nargs="+", choices=OUTPUT_FORMATS, default=['json'], help="Output formats: pretty-printed JSON and/or a SQLite snapshot.")
+    parser.add_argument("--changes-directory", help="Path to the directory where changesets are saved (default: OUTPUT_DIRECTORY/changes).")
     args = parser.parse_args()
 
     # Verify that the input directory exists
@@ -115,16 +369,23 @@ def main():
     # Create the output directory if it doesn't exist
     os.makedirs(args.output_directory, exist_ok=True)
 
+    only_files = read_files_from(args.files_from) if args.files_from else None
+
     # Process each Packages file in the input directory
-    for root, _, files in os.walk(args.input_directory):
-        for filename in tqdm(files, desc="Processing Packages files", unit="file"):
-            if filename.endswith('Packages'):
-                input_path = os.path.join(root, filename)
-                logging.info(f"Processing file: {input_path}")
-                process_packages_file(input_path, args.output_directory, args.input_directory, args.recursive)
+    input_paths = find_packages_files(args.input_directory, only_files)
+    try:
+        results = process_all_packages(input_paths, args.output_directory, args.input_directory, args.recursive, args.workers, tuple(args.format))
+    except ValueError as e:
+        logging.error(f"Error: {e}")
+        return
+
+    # Record which packages were added, removed, upgraded... since the previous run
+    changes_directory = args.changes_directory or os.path.join(args.output_directory, 'changes')
+    save_changes(results, args.output_directory, changes_directory)
 
     logging.info(f"All Packages files in {args.input_directory} have been processed. JSON outputs saved to {args.output_directory}")
 
 if __name__ == "__main__":
     setup_logging('json_parser.log')
-    main()
+    with run_summary('json_parser'):
+        main()
@@ -0,0 +1,639 @@
+# This module keeps the Packages.json files served by server.py in memory.
+
+# Each file is parsed once and indexed by package name. SQLite snapshots
+# (Packages.sqlite, see sqlite_snapshot.py) are opened read-only and
+# memory-mapped instead, and their rows are decoded on demand: when the server
+# runs several worker processes, they all share the pages of the same file
+# rather than each holding a parsed copy of every dataset. A dataset is reloaded only
+# when it changes on disk (e.g. after json_parser.py publishes new output),
+# and the new version replaces the old one atomically: requests that already
+# hold the old dataset keep using it until they are done.
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import zlib
+from bisect import bisect_left, bisect_right
+from email.utils import formatdate
+from debian_version import RELATIONS, version_key
+from instrumentation import increment, set_gauge, span
+from search_index import SearchIndex
+from dependencies import DependencyGraph
+from sqlite_snapshot import BODY_CHUNK_SIZE, SELECT_PACKAGES, decode_row, open_snapshot, read_body_chunk, read_layouts, stored_list
+
+# Number of rows decoded at a time when iterating over a SQLite snapshot
+SNAPSHOT_BATCH_SIZE = 1000
+
+# brotli is optional: without it, full lists are only pre-compressed with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def package_version_key(package):
+    """
+    Return the version key of a package entry (see debian_version.version_key()),
+    a package without a Version sorting like version "0".
+    """
+
+    return version_key(package.get("Version") or "")
+
+class SerializedList:
+    """
+    The JSON encoding of a full package list, built once per dataset version.
+
+    Attributes:
+        bodies (dict): The encoded body for each content coding ("identity", "gzip" and, if available, "br").
+        encodings (tuple): The content codings available.
+        etag (str): A strong entity tag of the JSON content, without quotes.
+        last_modified (str): The HTTP date of the dataset file.
+    """
+
+    def __init__(self, packages, mtime):
+        # Same encoding as FastAPI's JSONResponse
+        body = json.dumps(list(packages), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+        self.bodies = {
+            "identity": body,
+            "gzip": gzip.compress(body, compresslevel=6),
+        }
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=5)
+
+        self.encodings = tuple(self.bodies)
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.last_modified = formatdate(mtime, usegmt=True)
+
+    def size(self, encoding):
+        """
+        Return the size of the body in a content coding.
+        """
+
+        return len(self.bodies[encoding])
+
+    def stream(self, encoding):
+        """
+        Yield the body in a content coding, here in a single chunk.
+        """
+
+        yield self.bodies[encoding]
+
+class StoredList:
+    """
+    The full package list pre-encoded in a SQLite snapshot, with the same interface as
+    SerializedList, but whose bodies are read from the snapshot in chunks while they are sent.
+
+    Attributes:
+        encodings (tuple): The content codings available, "identity" being decompressed from "gzip".
+        etag (str): A strong entity tag of the JSON content, without quotes.
+        last_modified (str): The HTTP date of the dataset file.
+    """
+
+    def __init__(self, connection, lock, mtime):
+        self._connection = connection
+        self._lock = lock
+        with lock:
+            self.etag, self._size, self._bodies = stored_list(connection)
+        self.encodings = ("identity",) + tuple(self._bodies)
+        self.last_modified = formatdate(mtime, usegmt=True)
+
+    def size(self, encoding):
+        """
+        Return the size of the body in a content coding.
+        """
+
+        return self._size if encoding == "identity" else self._bodies[encoding][1]
+
+    def stream(self, encoding):
+        """
+        Yield the body in a content coding, one chunk at a time.
+        """
+
+        if encoding != "identity":
+            yield from self._read_chunks(encoding)
+            return
+
+        # Bound the size of each decompressed chunk as well
+        decompressor = zlib.decompressobj(31)
+        for chunk in self._read_chunks("gzip"):
+            while chunk:
+                data = decompressor.decompress(chunk, BODY_CHUNK_SIZE)
+                if data:
+                    yield data
+                chunk = decompressor.unconsumed_tail
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def _read_chunks(self, encoding):
+        rowid, size = self._bodies[encoding]
+        for offset in range(0, size, BODY_CHUNK_SIZE):
+            # The lock is only held for one chunk, so lookups on the same snapshot are not kept waiting
+            with self._lock:
+                chunk = read_body_chunk(self._connection, rowid, offset, BODY_CHUNK_SIZE)
+            yield chunk
+
+class Dataset:
+    """
+    A parsed Packages.json file, indexed by package name.
+
+    Attributes:
+        path (str): Path of the Packages.json file.
+        version (tuple): Identity of the file on disk when it was loaded (mtime, size, inode).
+        mtime (float): Modification time of the file when it was loaded.
+        packages (list): The package entries, in file order.
+        by_name (dict): The first package entry for each package name.
+    """
+
+    def __init__(self, path, version, mtime, packages):
+        self.path = path
+        self.version = version
+        self.mtime = mtime
+        self.packages = packages
+
+        self.by_name = {}
+        for package in packages:
+            # Earlier versions of json_parser.py wrote a version_key in the entries, it is not served
+            package.pop("version_key", None)
+            self.by_name.setdefault(package.get("Package"), package)
+
+        # Derived structures (serialized list, search index...), built on first use
+        self._derived = {}
+        self._derived_lock = threading.Lock()
+
+    def get(self, package_name):
+        """
+        Return the package entry with the given name, or None.
+        """
+
+        return self.by_name.get(package_name)
+
+    def latest(self, package_name):
+        """
+        Return the package entry with the given name and the highest version, or None.
+        """
+
+        return self._get_derived("latest", self._index_latest).get(package_name)
+
+    def _index_latest(self):
+        latest = {}
+        for package in self.packages:
+            name = package.get("Package")
+            key = package_version_key(package)
+            if name not in latest or key > latest[name][0]:
+                latest[name] = (key, package)
+        return {name: package for name, (_, package) in latest.items()}
+
+    def name_versions(self):
+        """
+        Return the versions of each package name in the dataset, built on first use.
+
+        Returns:
+            dict: Package name -> list of (version, version key) pairs, in file order.
+        """
+
+        return self._get_derived("name_versions", self._index_versions)
+
+    def _index_versions(self):
+        versions = {}
+        for package in self.packages:
+            versions.setdefault(package.get("Package"), []).append((package.get("Version"), package_version_key(package)))
+        return versions
+
+    def satisfies(self, package_name, alternative):
+        """
+        Check whether a version of a package matches the version constraint of a relationship
+        alternative, e.g. {"name": "libc6", "relation": ">=", "version": "2.34"}.
+
+        Used by DependencyGraph.closure() to resolve versioned dependencies.
+        """
+
+        relation = alternative.get("relation")
+        if relation is None:
+            return True
+
+        required = version_key(alternative["version"])
+        return any(RELATIONS[relation](key, required) for _, key in self.name_versions().get(package_name, []))
+
+    def in_version_range(self, min_version=None, max_version=None):
+        """
+        Return the package entries whose version is within a range, with a search in the sorted version index.
+
+        Args:
+            min_version (str): The lowest version included, or None.
+            max_version (str): The highest version included, or None.
+
+        Returns:
+            list: The package entries, sorted by version (then in file order).
+        """
+
+        keys, positions = self._get_derived("version_index", self._index_by_version)
+        start = 0 if min_version is None else bisect_left(keys, version_key(min_version))
+        end = len(keys) if max_version is None else bisect_right(keys, version_key(max_version))
+        return [self.packages[position] for position in positions[start:end]]
+
+    def _index_by_version(self):
+        ordered = sorted((package_version_key(package), position) for position, package in enumerate(self.packages))
+        return [key for key, _ in ordered], [position for _, position in ordered]
+
+    def in_section(self, section):
+        """
+        Return the package entries of a section (e.g. "games"), in file order.
+        """
+
+        sections = self._get_derived("sections", self._index_sections)
+        return sections.get(section, [])
+
+    def _index_sections(self):
+        sections = {}
+        for package in self.packages:
+            sections.setdefault(package.get("Section"), []).append(package)
+        return sections
+
+    def _get_derived(self, name, build):
+        # Build a derived structure once, even if several threads ask for it at the same time
+        value = self._derived.get(name)
+        if value is None:
+            with self._derived_lock:
+                value = self._derived.get(name)
+                if value is None:
+                    increment("derived_cache_total", structure=name, result="miss")
+                    with span("derived_build", structure=name):
+                        value = build()
+                    self._derived[name] = value
+                    return value
+        increment("derived_cache_total", structure=name, result="hit")
+        return value
+
+    def serialized(self):
+        """
+        Return the pre-encoded full package list, building it on first use.
+
+        Returns:
+            SerializedList: The encoded bodies, ETag and Last-Modified of the full list
+                            (a StoredList for SQLite snapshots).
+        """
+
+        return self._get_derived("serialized", lambda: SerializedList(self.packages, self.mtime))
+
+    def search_index(self):
+        """
+        Return the search index of the dataset, building it on first use.
+
+        Returns:
+            SearchIndex: Name, description and tag indexes over the packages.
+        """
+
+        return self._get_derived("search_index", lambda: SearchIndex(self.packages))
+
+    def dependency_graph(self):
+        """
+        Return the dependency graph of the dataset, building it on first use.
+
+        The indexes written by json_parser.py in Packages.deps.json are used when they are
+        at least as recent as the dataset, otherwise they are rebuilt from the packages.
+
+        Returns:
+            DependencyGraph: Forward and reverse dependency indexes of the packages.
+        """
+
+        return self._get_derived("dependency_graph", self._load_dependency_graph)
+
+    def _load_dependency_graph(self):
+        deps_path = os.path.splitext(self.path)[0] + ".deps.json"
+        try:
+            if os.stat(deps_path).st_mtime_ns >= self.version[0]:
+                with open(deps_path, "r", encoding="utf-8") as file:
+                    return DependencyGraph.from_dict(json.load(file))
+        except (OSError, ValueError, KeyError):
+            pass
+        return DependencyGraph.from_packages(self.packages)
+
+    def __len__(self):
+        return len(self.packages)
+
+class SnapshotPackages:
+    """
+    A read-only sequence of the package entries of a SQLite snapshot, decoded on demand.
+
+    Slicing returns another lazy sequence; positions map to package ids (position 0 is id 1).
+    """
+
+    def __init__(self, connection, lock, layouts, start, stop):
+        self._connection = connection
+        self._lock = lock
+        self._layouts = layouts
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return max(self._stop - self._start, 0)
+
+    def _fetch(self, start, stop):
+        with self._lock:
+            rows = self._connection.execute(
+                SELECT_PACKAGES + " WHERE p.id > ? AND p.id <= ? ORDER BY p.id", (start, stop)
+            ).fetchall()
+        return [decode_row(row, self._layouts) for row in rows]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            return SnapshotPackages(self._connection, self._lock, self._layouts, self._start + start, self._start + max(stop, start))
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("package index out of range")
+        return self._fetch(self._start + index, self._start + index + 1)[0]
+
+    def __iter__(self):
+        for start in range(self._start, self._stop, SNAPSHOT_BATCH_SIZE):
+            yield from self._fetch(start, min(start + SNAPSHOT_BATCH_SIZE, self._stop))
+
+class SnapshotDataset(Dataset):
+    """
+    A SQLite snapshot of a Packages file, queried through its indexes instead of being loaded in memory.
+
+    It offers the same interface as Dataset. The encoded full list is streamed from the snapshot,
+    and the dependency graph is read from Packages.deps.json like for a Packages.json; the search
+    index is still built from the full list of packages on first use, in each process.
+    """
+
+    def __init__(self, path, version, mtime):
+        self.path = path
+        self.version = version
+        self.mtime = mtime
+
+        self._connection = open_snapshot(path)
+        self._lock = threading.Lock()
+        self._layouts = read_layouts(self._connection)
+        count = self._connection.execute("SELECT COUNT(*) FROM packages").fetchone()[0]
+        self.packages = SnapshotPackages(self._connection, self._lock, self._layouts, 0, count)
+
+        self._derived = {}
+        self._derived_lock = threading.Lock()
+
+    def get(self, package_name):
+        with self._lock:
+            row = self._connection.execute(
+                SELECT_PACKAGES + " WHERE p.package = ? ORDER BY p.id LIMIT 1", (package_name,)
+            ).fetchone()
+        return decode_row(row, self._layouts) if row else None
+
+    def in_section(self, section):
+        with self._lock:
+            rows = self._connection.execute(
+                SELECT_PACKAGES + " WHERE p.section_id = (SELECT id FROM strings WHERE value = ?) ORDER BY p.id",
+                (section,)
+            ).fetchall()
+        return [decode_row(row, self._layouts) for row in rows]
+
+    def serialized(self):
+        return self._get_derived("serialized", lambda: StoredList(self._connection, self._lock, self.mtime))
+
+    def latest(self, package_name):
+        with self._lock:
+            row = self._connection.execute(
+                SELECT_PACKAGES + " WHERE p.package = ? ORDER BY p.version_key DESC, p.id LIMIT 1", (package_name,)
+            ).fetchone()
+        return decode_row(row, self._layouts) if row else None
+
+    def in_version_range(self, min_version=None, max_version=None):
+        conditions, parameters = [], []
+        if min_version is not None:
+            conditions.append("p.version_key >= ?")
+            parameters.append(version_key(min_version))
+        if max_version is not None:
+            conditions.append("p.version_key <= ?")
+            parameters.append(version_key(max_version))
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+
+        with self._lock:
+            rows = self._connection.execute(SELECT_PACKAGES + where + " ORDER BY p.version_key, p.id", parameters).fetchall()
+        return [decode_row(row, self._layouts) for row in rows]
+
+    def _index_versions(self):
+        # Only the name and version columns are needed, no record has to be decoded
+        with self._lock:
+            rows = self._connection.execute("SELECT package, version, version_key FROM packages ORDER BY id").fetchall()
+        versions = {}
+        for name, version, key in rows:
+            versions.setdefault(name, []).append((version, key))
+        return versions
+
+def file_version(stat):
+    """
+    Identify a version of a file from its os.stat() result.
+    """
+
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def preferred_dataset_file(base_path):
+    """
+    Choose between base_path.sqlite and base_path.json: the SQLite snapshot, unless
+    it is older than the JSON (e.g. json_parser.py was last run without --format sqlite).
+
+    Returns:
+        str: The path of the file to serve, or None if neither exists.
+    """
+
+    try:
+        snapshot_mtime = os.stat(base_path + ".sqlite").st_mtime_ns
+    except FileNotFoundError:
+        snapshot_mtime = None
+    try:
+        json_mtime = os.stat(base_path + ".json").st_mtime_ns
+    except FileNotFoundError:
+        json_mtime = None
+
+    if snapshot_mtime is not None and (json_mtime is None or snapshot_mtime >= json_mtime):
+        return base_path + ".sqlite"
+    if json_mtime is not None:
+        return base_path + ".json"
+    return None
+
+def discover_datasets(root):
+    """
+    Find the datasets published by json_parser.py under an output directory.
+
+    Both layouts are recognized: <codename>/<branch>/binary-<arch>/ (as downloaded by
+    repo_downloader.py) and <branch>/binary-<arch>/ (a single codename, which is then None).
+    A SQLite snapshot is preferred to Packages.json when both exist, see preferred_dataset_file().
+
+    Args:
+        root (str): The output directory.
+
+    Returns:
+        list: (codename, branch, architecture, path) tuples, sorted.
+    """
+
+    datasets = []
+
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        parts = os.path.relpath(directory, root).split(os.sep)
+        if len(parts) not in (2, 3) or not parts[-1].startswith("binary-"):
+            continue
+
+        if "Packages.sqlite" in files or "Packages.json" in files:
+            path = preferred_dataset_file(os.path.join(directory, "Packages"))
+            if path is not None:
+                codename = parts[0] if len(parts) == 3 else None
+                datasets.append((codename, parts[-2], parts[-1][len("binary-"):], path))
+
+    return sorted(datasets, key=lambda dataset: (dataset[0] or "", dataset[1], dataset[2]))
+
+class LocationIndex:
+    """
+    A global index of where each package name exists, across all codenames, branches and architectures.
+
+    Attributes:
+        signature (tuple): The paths and versions of the datasets the index was built from.
+        locations (dict): Package name -> list of {"codename", "branch", "architecture", "version"} dicts.
+        by_version (dict): Package name -> the same locations, highest version first.
+    """
+
+    def __init__(self, signature, datasets):
+        self.signature = signature
+        self.locations = {}
+        keyed = {}
+
+        for (codename, branch, architecture, _), dataset in datasets:
+            for name, versions in dataset.name_versions().items():
+                entries = self.locations.setdefault(name, [])
+                for version, key in versions:
+                    location = {"codename": codename, "branch": branch, "architecture": architecture, "version": version}
+                    entries.append(location)
+                    keyed.setdefault(name, []).append((key, location))
+
+        # Stable sort on the key only: equal versions keep the order of the datasets
+        self.by_version = {
+            name: [location for _, location in sorted(pairs, key=lambda pair: pair[0], reverse=True)]
+            for name, pairs in keyed.items()
+        }
+
+    def get(self, package_name):
+        """
+        Return the locations of a package name, or an empty list.
+        """
+
+        return self.locations.get(package_name, [])
+
+    def latest(self, package_name, codenames=None, branch=None, architecture=None):
+        """
+        Return the location of the highest version of a package name, optionally restricted
+        to some codenames, a branch and an architecture, or None.
+        """
+
+        for location in self.by_version.get(package_name, []):
+            if (codenames is None or location["codename"] in codenames) \
+                    and (branch is None or location["branch"] == branch) \
+                    and (architecture is None or location["architecture"] == architecture):
+                return location
+        return None
+
+class PackageStore:
+    """
+    A thread-safe cache of Datasets, keyed by file path and reloaded when the file changes.
+    """
+
+    def __init__(self):
+        self._datasets = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._location_index = None
+
+    def _lock_for(self, path):
+        with self._locks_lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def get(self, path):
+        """
+        Return the Dataset for a Packages.json file or a Packages.sqlite snapshot,
+        loading it if it is missing or stale.
+
+        Args:
+            path (str): Path of the Packages.json or Packages.sqlite file.
+
+        Returns:
+            Dataset: The current version of the dataset.
+
+        Raises:
+            FileNotFoundError: If the file does not exist.
+        """
+
+        stat = os.stat(path)
+        dataset = self._datasets.get(path)
+        if dataset is not None and dataset.version == file_version(stat):
+            increment("dataset_cache_total", result="hit")
+            return dataset
+
+        # Only one thread loads a given file, the others wait and reuse its result
+        with self._lock_for(path):
+            if path.endswith(".sqlite"):
+                stat = os.stat(path)
+                dataset = self._datasets.get(path)
+                if dataset is not None and dataset.version == file_version(stat):
+                    increment("dataset_cache_total", result="hit")
+                    return dataset
+
+                increment("dataset_cache_total", result="miss")
+                with span("dataset_load", format="sqlite"):
+                    dataset = SnapshotDataset(path, file_version(stat), stat.st_mtime)
+            else:
+                with open(path, "r", encoding="utf-8") as file:
+                    # Stat the open file, so the version matches the content even if it is replaced meanwhile
+                    stat = os.fstat(file.fileno())
+                    dataset = self._datasets.get(path)
+                    if dataset is not None and dataset.version == file_version(stat):
+                        increment("dataset_cache_total", result="hit")
+                        return dataset
+
+                    increment("dataset_cache_total", result="miss")
+                    with span("dataset_load", format="json"):
+                        packages = json.load(file)
+                        dataset = Dataset(path, file_version(stat), stat.st_mtime, packages)
+
+            # Swap in the new version, readers holding the previous one are unaffected
+            self._datasets[path] = dataset
+            # The other file of the same dataset (Packages.json <-> Packages.sqlite) is no longer
+            # served, keeping it would hold a whole parsed list in memory for good
+            base_path, extension = os.path.splitext(path)
+            self._datasets.pop(base_path + (".json" if extension == ".sqlite" else ".sqlite"), None)
+            set_gauge("datasets_loaded", len(self._datasets))
+            return dataset
+
+    def location_index(self, root):
+        """
+        Return the global location index of the datasets under an output directory,
+        rebuilding it only when a dataset was added, removed or changed.
+
+        Args:
+            root (str): The output directory.
+
+        Returns:
+            LocationIndex: The current index.
+        """
+
+        discovered = discover_datasets(root)
+        signature = tuple((location[3], file_version(os.stat(location[3]))) for location in discovered)
+
+        index = self._location_index
+        if index is not None and index.signature == signature:
+            increment("location_index_cache_total", result="hit")
+            return index
+
+        with self._lock_for(("location_index", root)):
+            index = self._location_index
+            if index is None or index.signature != signature:
+                increment("location_index_cache_total", result="miss")
+                with span("location_index_build"):
+                    datasets = [(location, self.get(location[3])) for location in discovered]
+                    index = LocationIndex(signature, datasets)
+                self._location_index = index
+            return index
@@ -9,13 +9,334 @@
 # the codename, branch, and architecture.
 
 import os
+import json
+import lzma
+import zlib
+import hashlib
 import requests
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 import logging
 from setup_logging import setup_logging
+from instrumentation import increment, run_summary, span
 
-def download_packages(base_url, repo_config, selected_codenames, selected_branches, selected_architectures):
+# Local state used for incremental refreshes: ETag, Last-Modified and SHA256 of every downloaded Packages file
+STATE_FILE = ".repo_downloader_state.json"
+
+# Compressed variants of the Packages index, in order of preference ("" is the uncompressed file)
+COMPRESSIONS = (".xz", ".gz", "")
+
+# Size of the chunks streamed from the network to disk
+CHUNK_SIZE = 1024 * 1024
+
+def create_session(jobs, max_connections_per_host, retries, backoff_factor):
+    """
+    Create a requests Session with pooled, keep-alive connections and automatic retries.
+
+    Args:
+        - jobs (int): Number of concurrent downloads, used to size the connection pool.
+        - max_connections_per_host (int): Maximum number of open connections to a single host.
+        - retries (int): Number of retries for failed requests.
+        - backoff_factor (float): Backoff factor between retries (0.5 -> 0.5s, 1s, 2s, ...).
+
+    Returns:
+        requests.Session: The configured session.
+    """
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+    )
+
+    # pool_block makes extra threads wait for a free connection instead of opening new ones,
+    # so the per-host cap is respected even when --jobs is larger
+    adapter = HTTPAdapter(
+        pool_connections=max(jobs, 1),
+        pool_maxsize=max_connections_per_host,
+        pool_block=True,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+def load_state(state_path):
+    """
+    Load the download state saved by a previous run.
+
+    Args:
+        - state_path (str): Path to the state file.
+
+    Returns:
+        dict: A mapping of local Packages paths to their ETag, Last-Modified and SHA256.
+    """
+
+    try:
+        with open(state_path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable state file {state_path}: {e}")
+        return {}
+
+def save_state(state_path, state):
+    """
+    Atomically save the download state.
+
+    Args:
+        - state_path (str): Path to the state file.
+        - state (dict): A mapping of local Packages paths to their ETag, Last-Modified and SHA256.
+    """
+
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(state, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+def sha256_file(path):
+    """
+    Compute the SHA256 of a local file.
+
+    Args:
+        - path (str): Path to the file.
+
+    Returns:
+        str: The hex digest, or None if the file does not exist.
+    """
+
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+def parse_release_hashes(release_content):
+    """
+    Extract the SHA256 hash list from the content of an InRelease/Release file.
+
+    Args:
+        - release_content (str): The content of the InRelease or Release file.
+
+    Returns:
+        dict: A mapping of paths relative to the codename (e.g. main/binary-amd64/Packages) to SHA256 hashes.
+    """
+
+    hashes = {}
+    in_sha256 = False
+
+    for line in release_content.splitlines():
+        if line.startswith("SHA256:"):
+            in_sha256 = True
+            continue
+
+        # Entries of the hash list are continuation lines: " <hash> <size> <path>"
+        if in_sha256 and line.startswith(" "):
+            parts = line.split()
+            if len(parts) == 3:
+                hashes[parts[2]] = parts[0]
+        else:
+            in_sha256 = False
+
+    return hashes
+
+def fetch_release_hashes(session, base_url, codename):
+    """
+    Download the InRelease (or Release) file of a codename and return its SHA256 hash list.
+
+    Args:
+        - session (requests.Session): The shared session used to perform the request.
+        - base_url (str): The base URL of the Debian repository.
+        - codename (str): The codename whose release file is fetched.
+
+    Returns:
+        dict: A mapping of paths relative to the codename to SHA256 hashes, empty if unavailable.
+    """
+
+    for release_name in ("InRelease", "Release"):
+        url = f"{base_url}{codename}/{release_name}"
+        try:
+            with span("release_download", codename=codename):
+                response = session.get(url, timeout=60)
+        except requests.RequestException as e:
+            logging.warning(f"Failed to download {url}: {e}")
+            continue
+
+        if response.status_code == 200:
+            logging.info(f"Using hash list from {url}")
+            return parse_release_hashes(response.text)
+
+    logging.warning(f"No release file found for {codename}, falling back to conditional requests")
+    return {}
+
+def create_decompressor(suffix):
+    """
+    Create a streaming decompressor for a Packages variant.
+
+    Args:
+        - suffix (str): The suffix of the variant (".xz", ".gz" or "" for the uncompressed file).
+
+    Returns:
+        object: An object with a decompress(data) method, or None for the uncompressed file.
+    """
+
+    if suffix == ".xz":
+        return lzma.LZMADecompressor()
+    if suffix == ".gz":
+        # 16 + MAX_WBITS tells zlib to expect a gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return None
+
+def stream_to_file(response, decompressor, output_path):
+    """
+    Stream a response body to disk, decompressing it chunk by chunk so memory use stays bounded.
+
+    Args:
+        - response (requests.Response): A response opened with stream=True.
+        - decompressor (object): The decompressor returned by create_decompressor(), or None.
+        - output_path (str): The path of the file to write.
+
+    Returns:
+        str: The SHA256 of the decompressed content.
+
+    Raises:
+        EOFError: If the compressed stream was cut short.
+    """
+
+    digest = hashlib.sha256()
+
+    with open(output_path, "wb") as file:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            increment("download_bytes_total", len(chunk))
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            digest.update(chunk)
+            file.write(chunk)
+            increment("download_decompressed_bytes_total", len(chunk))
+
+        # zlib may keep some buffered output until it is flushed, lzma does not
+        if hasattr(decompressor, "flush"):
+            chunk = decompressor.flush()
+            digest.update(chunk)
+            file.write(chunk)
+            increment("download_decompressed_bytes_total", len(chunk))
+
+    # A truncated response decompresses without error, but never reaches the end of the stream
+    if decompressor is not None and not decompressor.eof:
+        raise EOFError("compressed stream ended before the end marker")
+
+    return digest.hexdigest()
+
+def download_file(session, url, download_path, cached=None, expected_sha256=None, compressions=COMPRESSIONS):
+    """
+    Download a single Packages file, skipping it when it is unchanged upstream.
+
+    The file is skipped without any request when the release hash list says it matches the local copy,
+    otherwise a conditional request is sent with the ETag and Last-Modified from the previous run.
+    The compressed variants (Packages.xz, Packages.gz) are preferred and decompressed while streaming,
+    falling back to the uncompressed file when they are not published.
+
+    Args:
+        - session (requests.Session): The shared session used to perform the request.
+        - url (str): The URL of the uncompressed Packages file.
+        - download_path (str): The local path where the Packages file will be saved.
+        - cached (dict): State saved by the previous run for this file, if any.
+        - expected_sha256 (str): SHA256 of the file according to the InRelease/Release hash list, if any.
+        - compressions (tuple): Suffixes of the variants to try, in order of preference.
+
+    Returns:
+        tuple: The status ("changed", "unchanged" or "failed") and the new state entry for this file.
+    """
+
+    cached = cached or {}
+    have_local_copy = os.path.exists(download_path)
+
+    if have_local_copy and expected_sha256 and cached.get("sha256") == expected_sha256:
+        logging.info(f"Skipping {url}: unchanged according to the release hash list")
+        return "unchanged", cached
+
+    # Create the folder structure if it doesn't exist
+    os.makedirs(os.path.dirname(download_path), exist_ok=True)
+
+    for suffix in compressions:
+        variant_url = url + suffix
+
+        # Only send conditional headers if there is a local copy to fall back on,
+        # and only for the variant the validators were received for
+        headers = {}
+        if have_local_copy and cached.get("url") == variant_url:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        logging.info(f"Downloading {variant_url} to {download_path} folder")
+
+        try:
+            # Perform the GET request to download the Packages file, timing it per URL
+            with span("download", url=variant_url), session.get(variant_url, headers=headers, timeout=60, stream=True) as response:
+                if response.status_code == 304:
+                    logging.info(f"Not modified: {variant_url}\n")
+                    return "unchanged", cached
+
+                if response.status_code in (403, 404):
+                    logging.info(f"{variant_url} is not available (HTTP {response.status_code})")
+                    continue
+
+                if response.status_code != 200:
+                    logging.error(f"Failed to download {variant_url} (HTTP {response.status_code})\n")
+                    return "failed", cached
+
+                # Write next to the final file so that a failed download never leaves a truncated index
+                tmp_path = f"{download_path}.part"
+                sha256 = stream_to_file(response, create_decompressor(suffix), tmp_path)
+                entry = {
+                    "url": variant_url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "sha256": sha256,
+                }
+        except (requests.RequestException, lzma.LZMAError, zlib.error, EOFError, OSError) as e:
+            logging.error(f"Failed to download {variant_url}: {e}\n")
+            if os.path.exists(f"{download_path}.part"):
+                os.remove(f"{download_path}.part")
+            return "failed", cached
+
+        # Never replace the local copy with content the release hash list does not vouch for
+        if expected_sha256 and sha256 != expected_sha256:
+            os.remove(tmp_path)
+            logging.error(f"Failed to download {variant_url}: SHA256 {sha256} does not match the release hash list ({expected_sha256})\n")
+            return "failed", cached
+
+        # The server ignored the conditional request but the content is identical
+        if have_local_copy and sha256 == (cached.get("sha256") or sha256_file(download_path)):
+            os.remove(tmp_path)
+            logging.info(f"Content unchanged: {variant_url}\n")
+            return "unchanged", entry
+
+        # Save the downloaded content to the local file
+        os.replace(tmp_path, download_path)
+        logging.info(f"Download successful: {variant_url}\n")
+        return "changed", entry
+
+    logging.error(f"Failed to download {url}: no variant available\n")
+    return "failed", cached
+
+def download_packages(base_url, repo_config, selected_codenames, selected_branches, selected_architectures,
+                      jobs=8, max_connections_per_host=4, retries=3, backoff_factor=0.5,
+                      state_path=STATE_FILE, force=False, compressions=COMPRESSIONS):
     """
     Download Packages files based on user selection.
 
@@ -25,54 +346,98 @@ def download_packages(base_url, repo_config, selected_codenames, selected_branch
         - selected_codenames (list): User-selected codenames.
         - selected_branches (list): User-selected branches.
         - selected_architectures (list): User-selected architectures.
+        - jobs (int): Number of Packages files downloaded concurrently.
+        - max_connections_per_host (int): Maximum number of open connections to a single host.
+        - retries (int): Number of retries for failed requests.
+        - backoff_factor (float): Backoff factor between retries.
+        - state_path (str): Path to the state file used for incremental refreshes.
+        - force (bool): Ignore the saved state and download every file in full.
+        - compressions (tuple): Suffixes of the Packages variants to try, in order of preference.
+
+    Returns:
+        list: Local paths of the Packages files that changed during this run.
     """
 
-    # Count the total number of iterations for tqdm
-    total_iterations = len(selected_codenames) * len(selected_branches) * len(selected_architectures)
+    # Build the list of (codename, url, download_path, release_path) tuples to fetch
+    downloads = []
 
-    # Use tqdm to display an overall progress bar
-    with tqdm(total=total_iterations, desc="Downloading Packages", unit="package") as pbar:
-        # Iterate over selected codenames
-        for codename in selected_codenames:
-            if codename not in repo_config["codenames"]:
-                logging.warning(f"Ignoring invalid codename: {codename}")
+    # Iterate over selected codenames
+    for codename in selected_codenames:
+        if codename not in repo_config["codenames"]:
+            logging.warning(f"Ignoring invalid codename: {codename}")
+            continue
+
+        # Iterate over selected branches
+        for branch in selected_branches:
+            if branch not in repo_config["branches"]:
+                logging.warning(f"Ignoring invalid branch: {branch}")
                 continue
 
-            # Iterate over selected branches
-            for branch in selected_branches:
-                if branch not in repo_config["branches"]:
-                    logging.warning(f"Ignoring invalid branch: {branch}")
+            # Iterate over selected architectures
+            for arch in selected_architectures:
+                if arch not in repo_config["architectures"]:
+                    logging.warning(f"Ignoring invalid architecture: {arch}")
                     continue
 
-                # Iterate over selected architectures
-                for arch in selected_architectures:
-                    if arch not in repo_config["architectures"]:
-                        logging.warning(f"Ignoring invalid architecture: {arch}")
-                        continue
-
-                    # Build the URL for the Packages file
-                    url = f"{base_url}{codename}/{branch}/{arch}/Packages"
-                    # Define the local path where the Packages file will be saved
-                    download_path = f"{codename}/{branch}/{arch}/Packages"
-
-                    # Create the folder structure if it doesn't exist
-                    os.makedirs(os.path.dirname(download_path), exist_ok=True)
-
-                    logging.info(f"Downloading {url} to {download_path} folder")
-
-                    # Perform the GET request to download the Packages file
-                    response = requests.get(url)
-                    if response.status_code == 200:
-                        # Save the downloaded content to the local file
-                        with open(download_path, "wb") as file:
-                            file.write(response.content)
-                        logging.info(f"Download successful\n")
+                # Build the URL for the Packages file
+                url = f"{base_url}{codename}/{branch}/{arch}/Packages"
+                # Define the local path where the Packages file will be saved
+                download_path = f"{codename}/{branch}/{arch}/Packages"
+
+                downloads.append((codename, url, download_path, f"{branch}/{arch}/Packages"))
+
+    logging.info(f"Downloading {len(downloads)} Packages files from {urlsplit(base_url).netloc} with {jobs} jobs")
+
+    state = {} if force else load_state(state_path)
+    changed = []
+    failed = 0
+
+    with create_session(jobs, max_connections_per_host, retries, backoff_factor) as session:
+        # One hash list per codename lets unchanged files be skipped without any request
+        release_hashes = {}
+        if not force:
+            for codename in sorted({download[0] for download in downloads}):
+                release_hashes[codename] = fetch_release_hashes(session, base_url, codename)
+
+        # Use tqdm to display an overall progress bar
+        with tqdm(total=len(downloads), desc="Downloading Packages", unit="package") as pbar:
+            with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+                futures = {
+                    executor.submit(
+                        download_file, session, url, download_path,
+                        state.get(download_path), release_hashes.get(codename, {}).get(release_path),
+                        compressions
+                    ): download_path
+                    for codename, url, download_path, release_path in downloads
+                }
+
+                for future in as_completed(futures):
+                    download_path = futures[future]
+                    status, entry = future.result()
+                    increment("download_files_total", status=status)
+
+                    if status == "failed":
+                        failed += 1
                     else:
-                        logging.error(f"Failed to download {url}\n")
+                        state[download_path] = entry
+                        if status == "changed":
+                            changed.append(download_path)
 
                     # Update the tqdm progress bar
                     pbar.update(1)
 
+    save_state(state_path, state)
+
+    changed.sort()
+    logging.info(f"{len(changed)} of {len(downloads)} Packages files changed")
+    for download_path in changed:
+        logging.info(f"Changed: {download_path}")
+
+    if failed:
+        logging.error(f"{failed} of {len(downloads)} Packages files failed to download")
+
+    return changed
+
 def main():
     # Set up command-line argument parsing
     parser = argparse.ArgumentParser(description="Download Parrot Packages files from a specified repository.")
@@ -80,6 +445,14 @@ def main():
     parser.add_argument("--codename", nargs="+", help="Specify codenames to download Packages for.")
     parser.add_argument("--branch", nargs="+", help="Specify branches to download Packages for.")
     parser.add_argument("--architecture", nargs="+", help="Specify architectures to download Packages for.")
+    parser.add_argument("--jobs", type=int, default=8, help="Number of Packages files to download concurrently.")
+    parser.add_argument("--max-connections-per-host", type=int, default=4, help="Maximum number of open connections to a single host.")
+    parser.add_argument("--retries", type=int, default=3, help="Number of retries for failed downloads.")
+    parser.add_argument("--backoff", type=float, default=0.5, help="Backoff factor in seconds between retries.")
+    parser.add_argument("--state-file", default=STATE_FILE, help="Specify the file used to remember ETag, Last-Modified and SHA256 of downloaded files.")
+    parser.add_argument("--force", action="store_true", help="Ignore the saved state and download every Packages file in full.")
+    parser.add_argument("--no-compression", action="store_true", help="Download the uncompressed Packages files instead of Packages.xz/Packages.gz.")
+    parser.add_argument("--changed-list", help="Write the paths of the Packages files that changed to this file, one per line.")
 
     # Parse command-line arguments
     args = parser.parse_args()
@@ -97,8 +470,18 @@ def main():
     selected_architectures = args.architecture or repo_config["architectures"]
 
     # Call the function to download Packages files
-    download_packages(args.base_url, repo_config, selected_codenames, selected_branches, selected_architectures)
+    changed = download_packages(args.base_url, repo_config, selected_codenames, selected_branches, selected_architectures,
+                                jobs=args.jobs, max_connections_per_host=args.max_connections_per_host,
+                                retries=args.retries, backoff_factor=args.backoff,
+                                state_path=args.state_file, force=args.force,
+                                compressions=("",) if args.no_compression else COMPRESSIONS)
+
+    # Let the later stages process only the files that changed
+    if args.changed_list:
+        with open(args.changed_list, "w") as file:
+            file.writelines(f"{path}\n" for path in changed)
 
 if __name__ == "__main__":
     setup_logging('repo_downloader.log')
-    main()
+    with run_summary('repo_downloader'):
+        main()
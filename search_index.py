@@ -0,0 +1,168 @@
+# This module implements the search index used by the /search endpoint of server.py.
+
+# It is built once per dataset and supports:
+# - "prefix" search on package names, with a sorted array of names and bisect;
+# - "substring" search on package names, with a single scan of all the names joined together;
+# - "keyword" search on names, descriptions and debtags (the Tag field), with inverted
+#   indexes mapping each token to the packages containing it. Results are ranked.
+
+import re
+from bisect import bisect_left, bisect_right
+
+# Words shorter than this, and very common English words, are not indexed
+MIN_TOKEN_LENGTH = 2
+STOPWORDS = frozenset(["an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it",
+                       "of", "on", "or", "that", "the", "this", "to", "with"])
+
+# Ranking weights
+SCORE_EXACT_NAME = 100
+SCORE_NAME_PREFIX = 50
+SCORE_TOKEN_IN_NAME = 10
+SCORE_TOKEN_IN_TAG = 4
+SCORE_TOKEN_IN_DESCRIPTION = 2
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def tokenize(text):
+    """
+    Split a text into lowercase search tokens, dropping stopwords and very short words.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list: The tokens, in order of appearance.
+    """
+
+    return [token for token in TOKEN_RE.findall(text.lower())
+            if len(token) >= MIN_TOKEN_LENGTH and token not in STOPWORDS]
+
+def split_tags(tag_field):
+    """
+    Split the value of a Tag field into debtags, e.g. ["game::strategy", "role::program"].
+    """
+
+    return [tag.strip() for tag in tag_field.split(",") if tag.strip()]
+
+class SearchIndex:
+    """
+    Name, description and tag indexes over a list of packages.
+
+    Results are positions in the list of packages the index was built from.
+    """
+
+    def __init__(self, packages):
+        self.names = [package.get("Package", "").lower() for package in packages]
+
+        # Sorted (name, position) pairs for prefix search
+        self.sorted_names = sorted((name, position) for position, name in enumerate(self.names))
+        self.sorted_keys = [name for name, _ in self.sorted_names]
+
+        # All names joined by newlines, and the offset where each one starts, for substring search
+        self.joined_names = "\n".join(self.names)
+        self.name_offsets = []
+        offset = 0
+        for name in self.names:
+            self.name_offsets.append(offset)
+            offset += len(name) + 1
+
+        # Inverted indexes: token -> positions, and debtag -> positions
+        self.description_postings = {}
+        self.tag_token_postings = {}
+        self.tag_postings = {}
+
+        for position, package in enumerate(packages):
+            for token in set(tokenize(package.get("Description", ""))):
+                self.description_postings.setdefault(token, []).append(position)
+
+            tags = split_tags(package.get("Tag", ""))
+            for tag in tags:
+                self.tag_postings.setdefault(tag, []).append(position)
+            for token in set(token for tag in tags for token in tokenize(tag)):
+                self.tag_token_postings.setdefault(token, []).append(position)
+
+    def prefix(self, query):
+        """
+        Return the positions of the packages whose name starts with query, in name order.
+        """
+
+        query = query.lower()
+        start = bisect_left(self.sorted_keys, query)
+        end = bisect_right(self.sorted_keys, query + "\uffff")
+        return [position for _, position in self.sorted_names[start:end]]
+
+    def substring(self, query):
+        """
+        Return the positions of the packages whose name contains query, in list order.
+        """
+
+        query = query.lower()
+        if not query or "\n" in query:
+            return []
+
+        positions = []
+        offset = self.joined_names.find(query)
+        while offset != -1:
+            position = bisect_right(self.name_offsets, offset) - 1
+            positions.append(position)
+
+            # Continue after the end of this name, each name is reported only once
+            next_offset = self.name_offsets[position] + len(self.names[position]) + 1
+            offset = self.joined_names.find(query, next_offset)
+
+        return positions
+
+    def with_tag(self, tag):
+        """
+        Return the positions of the packages having the given debtag (e.g. "game::strategy").
+        """
+
+        return list(self.tag_postings.get(tag, []))
+
+    def keyword(self, query):
+        """
+        Search packages by keywords in their name, description and tags.
+
+        Every keyword must match at least one of the three. Packages are ranked by where the
+        keywords were found (name, then tags, then description), exact and prefix name matches first.
+
+        Args:
+            query (str): The keywords.
+
+        Returns:
+            list: (score, position) pairs, best matches first.
+        """
+
+        query = query.strip().lower()
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return [(SCORE_EXACT_NAME, position) for position in self.prefix(query) if self.names[position] == query]
+
+        scores = None
+        for token in tokens:
+            token_scores = {}
+            for position in self.substring(token):
+                token_scores[position] = token_scores.get(position, 0) + SCORE_TOKEN_IN_NAME
+            for position in self.tag_token_postings.get(token, ()):
+                token_scores[position] = token_scores.get(position, 0) + SCORE_TOKEN_IN_TAG
+            for position in self.description_postings.get(token, ()):
+                token_scores[position] = token_scores.get(position, 0) + SCORE_TOKEN_IN_DESCRIPTION
+
+            # Keep only the packages matching all the keywords so far
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {position: score + token_scores[position]
+                          for position, score in scores.items() if position in token_scores}
+            if not scores:
+                return []
+
+        for position in scores:
+            name = self.names[position]
+            if name == query:
+                scores[position] += SCORE_EXACT_NAME
+            elif name.startswith(query):
+                scores[position] += SCORE_NAME_PREFIX
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], self.names[item[0]]))
+        return [(score, position) for position, score in ranked]
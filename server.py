@@ -2,54 +2,555 @@
 # for retrieving information about packages from a repository, 
 # based on user-provided query parameters.
 
+import argparse
 import json
+import logging
 import os
-from fastapi import FastAPI, HTTPException, Depends
+import shutil
+import time
+import uvicorn
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
+from package_store import PackageStore, discover_datasets, package_version_key, preferred_dataset_file
+from sqlite_snapshot import is_current_snapshot, write_snapshot
+from debian_version import version_key
+from dependencies import INSTALL_FIELDS, MAX_DEPTH, MAX_NODES, RELATIONSHIP_FIELDS
+from snapshot_diff import list_snapshot_ids, read_changesets
+from instrumentation import SHARED_METRICS_VARIABLE, collect_shared_metrics, increment, metrics, observe, share_metrics, shared_metrics_directory
 
 # Usage example:
+# Start the server with one worker process per core, serving SQLite snapshots shared by all the workers
+# python3 server.py --workers 8 --build-snapshots
+
 # Return the complete list of packages for a given branch and architecture
 # curl -X GET "http://127.0.0.1:8000/packages/?architecture=amd64&branch=main"
 
 # Return only the information of a specific package
 # curl -X GET "http://127.0.0.1:8000/packages/?package_name=0ad&architecture=amd64&branch=main"
 
+# Return the first 100 packages, only with some fields, one JSON object per line
+# curl -X GET "http://127.0.0.1:8000/packages/?architecture=amd64&branch=main&limit=100&fields=Package,Version,Filename&format=ndjson"
+
+# Search packages by keywords in their name, description and tags
+# curl -X GET "http://127.0.0.1:8000/search?q=strategy+game&architecture=amd64&branch=main"
+
+# Packages that depend on libssl3, and everything 0ad needs to be installed
+# curl -X GET "http://127.0.0.1:8000/packages/libssl3/rdepends?architecture=amd64&branch=main"
+# curl -X GET "http://127.0.0.1:8000/packages/0ad/closure?architecture=amd64&branch=main"
+
+# Packages added, removed, upgraded... since a snapshot
+# curl -X GET "http://127.0.0.1:8000/changes?since=20240101T000000Z"
+
+# Where 0ad exists, and at which versions, across all codenames, branches and architectures
+# curl -X GET "http://127.0.0.1:8000/packages/0ad/everywhere"
+
+# Request counts and latencies, cache hit rates... in the Prometheus text format
+# curl -X GET "http://127.0.0.1:8000/metrics"
+
+# Newest version of 0ad across lory and lory-updates, and the packages with a version >= 2.0
+# curl -X GET "http://127.0.0.1:8000/packages/0ad/latest?codename=lory,lory-updates"
+# curl -X GET "http://127.0.0.1:8000/packages/?architecture=amd64&branch=main&min_version=2.0"
+
+# Directory of the outputs of json_parser.py
+OUTPUT_DIRECTORY = "output"
+
+# Directory of the changesets written by json_parser.py
+CHANGES_DIRECTORY = os.path.join(OUTPUT_DIRECTORY, "changes")
+
+# Maximum number of changesets returned by /changes
+MAX_CHANGESETS = 100
+
+# Number of NDJSON records sent in each chunk of a streamed response
+NDJSON_BATCH_SIZE = 500
 
 # Use of Pydantic for validation of query parameters
 class PackageQueryParams(BaseModel):
     package_name: Optional[str] = None
     architecture: str
     branch: str
+    # Codename (e.g. "lory-updates") for outputs laid out as output/<codename>/<branch>/binary-<arch>
+    codename: Optional[str] = None
+    # Only return the packages of a section, e.g. "games"
+    section: Optional[str] = None
+    # Only return the packages with a version in this range (inclusive, compared like dpkg does)
+    min_version: Optional[str] = None
+    max_version: Optional[str] = None
+    # Pagination: maximum number of packages returned, and the X-Next-Cursor of the previous page
+    limit: Optional[int] = None
+    cursor: Optional[str] = None
+    # Comma-separated list of the fields to return, e.g. "Package,Version,Filename"
+    fields: Optional[str] = None
+    # "json" (default) or "ndjson" to stream one JSON object per line
+    format: Optional[str] = None
+
+class SearchQueryParams(BaseModel):
+    # Text to search, its meaning depends on mode
+    q: Optional[str] = None
+    architecture: str
+    branch: str
+    codename: Optional[str] = None
+    # "keyword" (default) searches names, descriptions and tags, "prefix" and "substring" only names
+    mode: str = "keyword"
+    # Only return packages having this debtag, e.g. "game::strategy"
+    tag: Optional[str] = None
+    limit: int = 50
+    cursor: Optional[str] = None
+    fields: Optional[str] = None
+
+SEARCH_MODES = ("keyword", "prefix", "substring")
+
+class LatestQueryParams(BaseModel):
+    # Comma-separated codenames to look in, e.g. "lory,lory-updates", all of them by default
+    codename: Optional[str] = None
+    branch: Optional[str] = None
+    architecture: Optional[str] = None
+
+class GraphQueryParams(BaseModel):
+    architecture: str
+    branch: str
+    codename: Optional[str] = None
+    # Comma-separated relationship fields to follow, Pre-Depends and Depends by default
+    relationships: Optional[str] = None
+    # How many levels to follow (1 for direct reverse dependencies, up to MAX_DEPTH)
+    max_depth: Optional[int] = None
+    # Maximum number of packages returned (up to MAX_NODES)
+    max_nodes: int = MAX_NODES
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # With several worker processes (see main()), each one shares its metrics with the others
+    directory = os.environ.get(SHARED_METRICS_VARIABLE)
+    stop_sharing = share_metrics(directory) if directory else None
+    yield
+    if stop_sharing is not None:
+        stop_sharing.set()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Count requests and time them until the response starts, per route template (not per URL)
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    increment("http_requests_total", method=request.method, route=path, status=response.status_code)
+    observe("http_request_duration_seconds", elapsed, method=request.method, route=path)
+    return response
+
+# Parsed Packages.json files, loaded once and reloaded only when they change on disk
+store = PackageStore()
 
 def get_query_params(query_params: PackageQueryParams = Depends()):
     return query_params
 
+def get_search_params(search_params: SearchQueryParams = Depends()):
+    return search_params
+
+def get_graph_params(graph_params: GraphQueryParams = Depends()):
+    return graph_params
+
+def get_latest_params(latest_params: LatestQueryParams = Depends()):
+    return latest_params
+
+def dataset_path(branch, architecture, codename=None):
+    # Build the path to the dataset of a codename, branch and architecture,
+    # preferring the SQLite snapshot written by json_parser.py --format sqlite (unless it is stale).
+    # Without a codename, the single-codename layout output/<branch>/binary-<arch> is used.
+    for part in (branch, architecture, codename):
+        if part is not None and (not part or part in (".", "..") or "/" in part or os.sep in part or "\x00" in part):
+            raise HTTPException(status_code=404, detail="Repository not found")
+
+    parts = [OUTPUT_DIRECTORY] + ([codename] if codename else []) + [branch, f"binary-{architecture}", "Packages"]
+    base_path = os.path.join(*parts)
+    return preferred_dataset_file(base_path) or base_path + ".json"
+
+async def load_dataset(branch, architecture, codename=None):
+    # Get the in-memory dataset, (re)loading it off the event loop if the file changed
+    try:
+        return await run_in_threadpool(store.get, dataset_path(branch, architecture, codename))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Repository not found")
+
+def choose_encoding(accept_encoding, available):
+    # Pick the best content coding accepted by the client among the pre-encoded ones
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+
+    for coding in ("br", "gzip"):
+        if coding in available and accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return "identity"
+
+def is_not_modified(request, serialized):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        for tag in if_none_match.split(","):
+            # Weak comparison, ignoring the content coding suffix of our entity tags
+            tag = tag.strip().removeprefix("W/").strip('"')
+            if tag.split("-", 1)[0] == serialized.etag:
+                return True
+        return False
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return parsedate_to_datetime(serialized.last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+def full_list_response(request, serialized):
+    # Serve the pre-encoded full list, or a 304 if the client already has it
+    encoding = choose_encoding(request.headers.get("accept-encoding", ""), serialized.encodings)
+    etag = serialized.etag if encoding == "identity" else f"{serialized.etag}-{encoding}"
+
+    headers = {
+        "ETag": f'"{etag}"',
+        "Last-Modified": serialized.last_modified,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+
+    if is_not_modified(request, serialized):
+        increment("full_list_responses_total", encoding=encoding, result="not_modified")
+        return Response(status_code=304, headers=headers)
+
+    increment("full_list_responses_total", encoding=encoding, result="sent")
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    headers["Content-Length"] = str(serialized.size(encoding))
+
+    # Snapshot bodies are read chunk by chunk (in the thread pool) while they are sent
+    return StreamingResponse(serialized.stream(encoding), media_type="application/json", headers=headers)
+
+def parse_cursor(cursor):
+    # Cursors are opaque to clients, they contain the offset of the next package
+    if cursor is None:
+        return 0
+    try:
+        offset = int(cursor)
+    except ValueError:
+        offset = -1
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return offset
+
+def parse_fields(fields):
+    # Split the comma-separated list of the fields= parameter
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+def project(package, fields):
+    # Keep only the requested fields of a package
+    return {field: package[field] for field in fields if field in package}
+
+def iter_ndjson(packages):
+    # Encode packages one per line, sending them in batches
+    batch = []
+    for package in packages:
+        batch.append(json.dumps(package, ensure_ascii=False))
+        if len(batch) >= NDJSON_BATCH_SIZE:
+            yield "\n".join(batch) + "\n"
+            batch = []
+    if batch:
+        yield "\n".join(batch) + "\n"
+
+def wants_ndjson(request, query_params):
+    if query_params.format is not None:
+        if query_params.format not in ("json", "ndjson"):
+            raise HTTPException(status_code=400, detail="Invalid format, expected json or ndjson")
+        return query_params.format == "ndjson"
+    return "application/x-ndjson" in request.headers.get("accept", "")
+
+def in_version_range(package, min_version, max_version):
+    # Compare the precomputed version key of a package with the bounds of the range
+    key = package_version_key(package)
+    return (min_version is None or key >= version_key(min_version)) and (max_version is None or key <= version_key(max_version))
+
 # Main endpoint
 @app.get("/packages/")
-async def get_packages(query_params: PackageQueryParams = Depends(get_query_params)):
-    try:
-        # Access validated input using query_params.package_name, query_params.architecture, query_params.branch
-
-        # Build the path to the Packages.json file
-        file_path = os.path.join("output", query_params.branch, f"binary-{query_params.architecture}", "Packages.json")
-
-        # Read the contents of the Packages.json file.
-        with open(file_path, "r") as file:
-            packages_data = json.load(file)
-
-        if query_params.package_name:
-            # If a package name is specified, it searches only for that package
-            package = next((pkg for pkg in packages_data if pkg["Package"] == query_params.package_name), None)
-            if package:
-                return [package]
-            else:
-                raise HTTPException(status_code=404, detail="Package not found")
+async def get_packages(request: Request, response: Response, query_params: PackageQueryParams = Depends(get_query_params)):
+    # Access validated input using query_params.package_name, query_params.architecture, query_params.branch
+    dataset = await load_dataset(query_params.branch, query_params.architecture, query_params.codename)
+
+    ndjson = wants_ndjson(request, query_params)
+    if query_params.limit is not None and query_params.limit < 1:
+        raise HTTPException(status_code=400, detail="Invalid limit, it must be at least 1")
+    version_range = query_params.min_version is not None or query_params.max_version is not None
+
+    if query_params.package_name:
+        # If a package name is specified, look it up in the name index
+        package = dataset.get(query_params.package_name)
+        if package and in_version_range(package, query_params.min_version, query_params.max_version):
+            packages = [package]
         else:
-            # If no package name is specified, return the full list of packages
-            return packages_data
+            raise HTTPException(status_code=404, detail="Package not found")
+    elif version_range:
+        # Use the version index, restricted to a section if one is given
+        packages = await run_in_threadpool(dataset.in_version_range, query_params.min_version, query_params.max_version)
+        if query_params.section:
+            packages = [package for package in packages if package.get("Section") == query_params.section]
+    elif query_params.section:
+        # Use the section index
+        packages = await run_in_threadpool(dataset.in_section, query_params.section)
+    elif not (ndjson or query_params.limit or query_params.cursor or query_params.fields):
+        # If no package name is specified, return the full list of packages,
+        # serialized and compressed once per dataset version
+        serialized = await run_in_threadpool(dataset.serialized)
+        return full_list_response(request, serialized)
+    else:
+        packages = dataset.packages
 
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="Repository not found")
+    # Select the requested page
+    start = parse_cursor(query_params.cursor)
+    end = len(packages) if query_params.limit is None else min(start + query_params.limit, len(packages))
+    page = packages[start:end]
+
+    headers = {}
+    if end < len(packages):
+        headers["X-Next-Cursor"] = str(end)
+
+    if query_params.fields:
+        fields = parse_fields(query_params.fields)
+        page = (project(package, fields) for package in page)
+
+    if ndjson:
+        # Stream the records, so the first bytes are sent before the whole page is encoded
+        return StreamingResponse(iter_ndjson(page), media_type="application/x-ndjson", headers=headers)
+
+    response.headers.update(headers)
+    return await run_in_threadpool(list, page)
+
+@app.get("/search")
+async def search_packages(response: Response, search_params: SearchQueryParams = Depends(get_search_params)):
+    if search_params.mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid mode, expected one of: {', '.join(SEARCH_MODES)}")
+    if not search_params.q and not search_params.tag:
+        raise HTTPException(status_code=400, detail="At least one of q and tag is required")
+    if search_params.limit < 1:
+        raise HTTPException(status_code=400, detail="Invalid limit, it must be at least 1")
+
+    dataset = await load_dataset(search_params.branch, search_params.architecture, search_params.codename)
+    index = await run_in_threadpool(dataset.search_index)
+
+    # Positions of the matching packages, best matches first
+    if not search_params.q:
+        positions = index.with_tag(search_params.tag)
+    elif search_params.mode == "prefix":
+        positions = index.prefix(search_params.q)
+    elif search_params.mode == "substring":
+        positions = index.substring(search_params.q)
+    else:
+        positions = [position for _, position in index.keyword(search_params.q)]
+
+    if search_params.q and search_params.tag:
+        tagged = set(index.with_tag(search_params.tag))
+        positions = [position for position in positions if position in tagged]
+
+    # Select the requested page
+    start = parse_cursor(search_params.cursor)
+    end = min(start + search_params.limit, len(positions))
+    page = [dataset.packages[position] for position in positions[start:end]]
+
+    if search_params.fields:
+        fields = parse_fields(search_params.fields)
+        page = [project(package, fields) for package in page]
+
+    response.headers["X-Total-Count"] = str(len(positions))
+    if end < len(positions):
+        response.headers["X-Next-Cursor"] = str(end)
+
+    return page
+
+def parse_relationship_fields(relationships):
+    # Validate the relationships= parameter of the dependency graph endpoints
+    if not relationships:
+        return INSTALL_FIELDS
+    fields = tuple(parse_fields(relationships))
+    invalid = [field for field in fields if field not in RELATIONSHIP_FIELDS]
+    if invalid or not fields:
+        raise HTTPException(status_code=400, detail=f"Invalid relationships, expected some of: {', '.join(RELATIONSHIP_FIELDS)}")
+    return fields
+
+def check_traversal_bounds(max_depth, max_nodes):
+    if max_depth is not None and not 1 <= max_depth <= MAX_DEPTH:
+        raise HTTPException(status_code=400, detail=f"Invalid max_depth, it must be between 1 and {MAX_DEPTH}")
+    if not 1 <= max_nodes <= MAX_NODES:
+        raise HTTPException(status_code=400, detail=f"Invalid max_nodes, it must be between 1 and {MAX_NODES}")
+
+async def load_dependency_graph(graph_params, package_name):
+    dataset = await load_dataset(graph_params.branch, graph_params.architecture, graph_params.codename)
+    graph = await run_in_threadpool(dataset.dependency_graph)
+    if package_name not in graph.forward and package_name not in graph.reverse:
+        raise HTTPException(status_code=404, detail="Package not found")
+    return dataset, graph
+
+@app.get("/packages/{package_name}/rdepends")
+async def get_reverse_dependencies(package_name: str, graph_params: GraphQueryParams = Depends(get_graph_params)):
+    # Packages depending on package_name (directly, or up to max_depth levels)
+    fields = parse_relationship_fields(graph_params.relationships)
+    max_depth = graph_params.max_depth or 1
+    check_traversal_bounds(max_depth, graph_params.max_nodes)
+
+    _, graph = await load_dependency_graph(graph_params, package_name)
+    rdepends, truncated = await run_in_threadpool(graph.rdepends, package_name, fields, max_depth, graph_params.max_nodes)
+
+    return {"package": package_name, "rdepends": rdepends, "truncated": truncated}
+
+@app.get("/packages/{package_name}/closure")
+async def get_dependency_closure(package_name: str, graph_params: GraphQueryParams = Depends(get_graph_params)):
+    # Everything package_name needs, following the first available alternative of each group
+    fields = parse_relationship_fields(graph_params.relationships)
+    max_depth = graph_params.max_depth or MAX_DEPTH
+    check_traversal_bounds(max_depth, graph_params.max_nodes)
+
+    dataset, graph = await load_dependency_graph(graph_params, package_name)
+
+    # Versioned alternatives, e.g. libc6 (>= 2.34), are only satisfied by a matching version
+    closure = await run_in_threadpool(graph.closure, package_name, fields, max_depth, graph_params.max_nodes, dataset.satisfies)
+
+    return {"package": package_name, **closure}
+
+@app.get("/changes")
+async def get_changes(since: Optional[str] = None, limit: int = MAX_CHANGESETS):
+    # Changesets newer than the snapshot "since", oldest first; clients pass back "latest" on the next call
+    if not 1 <= limit <= MAX_CHANGESETS:
+        raise HTTPException(status_code=400, detail=f"Invalid limit, it must be between 1 and {MAX_CHANGESETS}")
+
+    changesets = await run_in_threadpool(read_changesets, CHANGES_DIRECTORY, since, limit + 1)
+    truncated = len(changesets) > limit
+    changesets = changesets[:limit]
+
+    if changesets:
+        latest = changesets[-1]["id"]
+    else:
+        snapshot_ids = await run_in_threadpool(list_snapshot_ids, CHANGES_DIRECTORY)
+        latest = snapshot_ids[-1] if snapshot_ids else since
+
+    return {"since": since, "latest": latest, "truncated": truncated, "changesets": changesets}
+
+@app.get("/packages/{package_name}/everywhere")
+async def get_package_everywhere(package_name: str):
+    # Every codename, branch and architecture where package_name exists, from the global location index
+    index = await run_in_threadpool(store.location_index, OUTPUT_DIRECTORY)
+    locations = index.get(package_name)
+    if not locations:
+        raise HTTPException(status_code=404, detail="Package not found")
+
+    # Version matrix: codename -> branch -> architecture -> versions
+    matrix = {}
+    for location in locations:
+        codename = location["codename"] or ""
+        versions = matrix.setdefault(codename, {}).setdefault(location["branch"], {}).setdefault(location["architecture"], [])
+        versions.append(location["version"])
+
+    return {"package": package_name, "locations": locations, "matrix": matrix}
+
+@app.get("/packages/{package_name}/latest")
+async def get_latest_package(package_name: str, latest_params: LatestQueryParams = Depends(get_latest_params)):
+    # Highest version of package_name across the selected codenames, branches and architectures
+    index = await run_in_threadpool(store.location_index, OUTPUT_DIRECTORY)
+    codenames = set(parse_fields(latest_params.codename)) if latest_params.codename else None
+
+    location = index.latest(package_name, codenames, latest_params.branch, latest_params.architecture)
+    if location is None:
+        raise HTTPException(status_code=404, detail="Package not found")
+
+    return {"package": package_name, **location}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Metrics of the server, in the Prometheus text exposition format: of this process,
+    # or added up over all the worker processes when there are several
+    directory = os.environ.get(SHARED_METRICS_VARIABLE)
+    registry = await run_in_threadpool(collect_shared_metrics, directory) if directory else metrics
+    return PlainTextResponse(registry.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+def build_snapshots(root):
+    """
+    Write a SQLite snapshot next to each Packages.json that has none, only an older one,
+    or one written by another version of sqlite_snapshot.py.
+
+    Snapshots are memory-mapped and shared by all the worker processes, while a Packages.json
+    would be parsed and held in memory by each of them.
+
+    Args:
+        root (str): The output directory.
+
+    Returns:
+        list: Paths of the snapshots written.
+    """
+
+    written = []
+
+    for _, _, _, path in discover_datasets(root):
+        # discover_datasets() only returns a Packages.json when its snapshot is missing or stale
+        base_path = os.path.splitext(path)[0]
+        json_path, snapshot_path = base_path + ".json", base_path + ".sqlite"
+        if path == snapshot_path and (is_current_snapshot(path) or not os.path.exists(json_path)):
+            continue
+
+        with open(json_path, "r", encoding="utf-8") as file:
+            count = write_snapshot(json.load(file), snapshot_path)
+
+        # The dependency indexes of the JSON describe the same packages, keep them valid for the snapshot
+        deps_path = base_path + ".deps.json"
+        if os.path.exists(deps_path) and os.stat(deps_path).st_mtime_ns >= os.stat(json_path).st_mtime_ns:
+            os.utime(deps_path)
+        logging.info(f"Snapshot saved to {snapshot_path} ({count} packages)")
+        written.append(snapshot_path)
+
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the packages published by json_parser.py.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, e.g. one per core.")
+    parser.add_argument("--build-snapshots", action="store_true", help="Write a SQLite snapshot for each Packages.json without an up-to-date one before starting.")
+    args = parser.parse_args()
+
+    if args.build_snapshots:
+        build_snapshots(OUTPUT_DIRECTORY)
+
+    # Each worker would hold its own parsed copy of the datasets that have no snapshot
+    in_memory = [path for _, _, _, path in discover_datasets(OUTPUT_DIRECTORY) if path.endswith(".json")]
+    if args.workers > 1 and in_memory:
+        logging.warning(f"{len(in_memory)} datasets have no SQLite snapshot and will be loaded by every worker, "
+                        "use --build-snapshots or json_parser.py --format json sqlite")
+
+    if args.workers > 1:
+        # Inherited by the worker processes, see lifespan(); metrics start from zero on each start
+        directory = os.path.join(shared_metrics_directory(), str(args.port))
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        os.environ[SHARED_METRICS_VARIABLE] = directory
+
+    uvicorn.run("server:app", app_dir=os.path.dirname(os.path.abspath(__file__)),
+                host=args.host, port=args.port, workers=args.workers)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+    main()
@@ -0,0 +1,214 @@
+# This module computes what changed in a dataset between two refreshes.
+
+# Each time json_parser.py processes a Packages file, it saves a fingerprint of
+# the packages next to the JSON output (Packages.fingerprint.json): for each
+# (Package, Architecture) pair, the SHA256 of the .deb and its version. The new
+# fingerprint is compared with the previous one, and the differences of all the
+# datasets processed in a run are saved as a changeset in the changes directory
+# (output/changes/<snapshot id>.json), which server.py exposes at /changes.
+
+# New fingerprints are first saved aside (Packages.fingerprint.json.pending) and
+# only replace the previous ones once the changeset is saved: if a run fails
+# before that, the next run compares with the same previous fingerprints and
+# finds the same changes again, so none of them is lost.
+
+import json
+import os
+import time
+from debian_version import compare_versions
+
+def package_key(package):
+    """
+    Return the key identifying a package across refreshes: "Package/Architecture".
+    """
+
+    return f"{package.get('Package', '')}/{package.get('Architecture', '')}"
+
+def collect_fingerprint(packages, fingerprint):
+    """
+    Add the SHA256 and version of each package to a fingerprint as the packages stream by.
+
+    Args:
+        packages (iterable): Parsed package entries.
+        fingerprint (dict): The fingerprint to fill, "Package/Architecture" -> [SHA256, version].
+
+    Yields:
+        dict: The package entries, unchanged.
+    """
+
+    for package in packages:
+        fingerprint.setdefault(package_key(package), [package.get('SHA256'), package.get('Version')])
+        yield package
+
+def load_fingerprint(path):
+    """
+    Load a fingerprint saved by a previous run.
+
+    Returns:
+        dict: The fingerprint, or None if there is no previous fingerprint.
+    """
+
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def diff_fingerprints(old, new):
+    """
+    Compare two fingerprints.
+
+    Args:
+        old (dict): The fingerprint of the previous refresh.
+        new (dict): The fingerprint of the current refresh.
+
+    Returns:
+        dict: Lists of "added", "removed", "upgraded", "downgraded" and "rebuilt" packages
+              (same version, different SHA256), each sorted by package and architecture.
+    """
+
+    changes = {"added": [], "removed": [], "upgraded": [], "downgraded": [], "rebuilt": []}
+
+    for key in sorted(new.keys() | old.keys()):
+        package, _, architecture = key.rpartition('/')
+        entry = {"package": package, "architecture": architecture}
+
+        if key not in old:
+            changes["added"].append({**entry, "version": new[key][1]})
+        elif key not in new:
+            changes["removed"].append({**entry, "version": old[key][1]})
+        elif old[key][0] != new[key][0]:
+            old_version, new_version = old[key][1], new[key][1]
+            entry.update({"old_version": old_version, "new_version": new_version})
+
+            comparison = compare_versions(new_version or '', old_version or '')
+            if comparison > 0:
+                changes["upgraded"].append(entry)
+            elif comparison < 0:
+                changes["downgraded"].append(entry)
+            else:
+                changes["rebuilt"].append(entry)
+
+    return changes
+
+def pending_path(path):
+    """
+    Return the path where a new fingerprint waits until its changes are saved.
+    """
+
+    return f"{path}.pending"
+
+def stage_fingerprint(path, fingerprint):
+    """
+    Compare a new fingerprint with the one saved at path, and save it aside until commit_fingerprints().
+
+    Args:
+        path (str): Path of the Packages.fingerprint.json file.
+        fingerprint (dict): The fingerprint of the current refresh.
+
+    Returns:
+        dict: The changes (see diff_fingerprints()), or None if there was no previous fingerprint.
+    """
+
+    old = load_fingerprint(path)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(fingerprint, file, separators=(',', ':'), sort_keys=True)
+    os.replace(tmp_path, pending_path(path))
+
+    return None if old is None else diff_fingerprints(old, fingerprint)
+
+def commit_fingerprints(paths):
+    """
+    Replace the previous fingerprints with the ones saved by stage_fingerprint(),
+    once the changes they were compared for are saved.
+
+    Args:
+        paths (iterable): Paths of the Packages.fingerprint.json files.
+    """
+
+    for path in paths:
+        os.replace(pending_path(path), path)
+
+def new_snapshot_id(changes_directory):
+    """
+    Return a new snapshot id: the current UTC time, which sorts in chronological order.
+    """
+
+    snapshot_id = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    suffix = 1
+    candidate = snapshot_id
+    while os.path.exists(os.path.join(changes_directory, f"{candidate}.json")):
+        candidate = f"{snapshot_id}.{suffix}"
+        suffix += 1
+    return candidate
+
+def list_snapshot_ids(changes_directory):
+    """
+    Return the ids of the saved changesets, oldest first.
+    """
+
+    try:
+        filenames = os.listdir(changes_directory)
+    except FileNotFoundError:
+        return []
+    return sorted(filename[:-5] for filename in filenames if filename.endswith('.json'))
+
+def write_changeset(changes_directory, datasets):
+    """
+    Save the changes of a refresh as a new changeset.
+
+    Args:
+        changes_directory (str): The directory where changesets are saved.
+        datasets (dict): Dataset (e.g. "main/binary-amd64") -> changes, or None for a dataset seen for the first time.
+
+    Returns:
+        str: The id of the new snapshot.
+    """
+
+    os.makedirs(changes_directory, exist_ok=True)
+
+    previous_ids = list_snapshot_ids(changes_directory)
+    snapshot_id = new_snapshot_id(changes_directory)
+
+    changeset = {
+        "id": snapshot_id,
+        "previous": previous_ids[-1] if previous_ids else None,
+        "created": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "datasets": {
+            dataset: ({"initial": True} if changes is None else changes)
+            for dataset, changes in sorted(datasets.items())
+        },
+    }
+
+    path = os.path.join(changes_directory, f"{snapshot_id}.json")
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+        json.dump(changeset, file, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+    return snapshot_id
+
+def read_changesets(changes_directory, since=None, limit=None):
+    """
+    Read the changesets saved after a snapshot.
+
+    Args:
+        changes_directory (str): The directory where changesets are saved.
+        since (str): Only return changesets newer than this snapshot id, or all of them if None.
+        limit (int): Maximum number of changesets returned, oldest first.
+
+    Returns:
+        list: The changesets, oldest first.
+    """
+
+    snapshot_ids = [snapshot_id for snapshot_id in list_snapshot_ids(changes_directory)
+                    if since is None or snapshot_id > since]
+    if limit is not None:
+        snapshot_ids = snapshot_ids[:limit]
+
+    changesets = []
+    for snapshot_id in snapshot_ids:
+        with open(os.path.join(changes_directory, f"{snapshot_id}.json"), 'r', encoding='utf-8') as file:
+            changesets.append(json.load(file))
+    return changesets
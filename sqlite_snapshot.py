@@ -0,0 +1,354 @@
+# This module writes and reads the SQLite snapshot format of a Packages file,
+# an alternative to the pretty-printed Packages.json produced by json_parser.py.
+
+# A snapshot stores one row per package. Values that repeat across thousands of
+# packages (Architecture, Maintainer, Section, Priority) are interned in a strings
+# table and referenced by id, and the packages are indexed by name and version, by
+# version alone (range queries) and by section. The other fields are stored as a
+# zlib-compressed JSON array of values, without their names: the field names of a
+# package, in order, are stored once in a layouts table shared by all the packages
+# having the same fields.
+# server.py opens snapshots read-only and memory-mapped, and decodes only the rows
+# a query needs, so its memory use does not depend on the size of the repository.
+
+# A snapshot also stores the full package list already compressed as the server
+# sends it (gzip and, if available, brotli, of the compact JSON). The pages of the
+# file are shared by all the server worker processes through the operating
+# system's page cache, and bodies are read in chunks while they are sent, instead
+# of each worker keeping its own encoded copy in memory. The uncompressed JSON is
+# not stored, it is decompressed from the gzip body while it is sent.
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import zlib
+from debian_version import version_key
+
+# brotli is optional: without it, the full list is only pre-compressed with gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Fields stored once in the strings table and referenced by id
+INTERNED_FIELDS = ("Architecture", "Maintainer", "Section", "Priority")
+
+# Fields stored in their own column, and left out of the array of values
+COLUMN_FIELDS = ("id", "Package", "Version", "version_key") + INTERNED_FIELDS
+
+# zlib compression level of the stored records
+RECORD_COMPRESSION_LEVEL = 6
+
+# Size of the memory map used when reading a snapshot
+MMAP_SIZE = 1024 * 1024 * 1024
+
+# Version of the snapshot layout (PRAGMA user_version), snapshots of another version must be rebuilt
+SNAPSHOT_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE strings (
+    id INTEGER PRIMARY KEY,
+    value TEXT NOT NULL UNIQUE
+);
+CREATE TABLE layouts (
+    id INTEGER PRIMARY KEY,
+    fields TEXT NOT NULL UNIQUE
+);
+CREATE TABLE packages (
+    id INTEGER PRIMARY KEY,
+    package TEXT NOT NULL,
+    version TEXT,
+    version_key TEXT,
+    architecture_id INTEGER REFERENCES strings(id),
+    maintainer_id INTEGER REFERENCES strings(id),
+    section_id INTEGER REFERENCES strings(id),
+    priority_id INTEGER REFERENCES strings(id),
+    layout_id INTEGER NOT NULL REFERENCES layouts(id),
+    record BLOB NOT NULL
+);
+CREATE TABLE bodies (
+    encoding TEXT PRIMARY KEY,
+    body BLOB NOT NULL
+);
+CREATE TABLE metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Size of the chunks copied into and out of the stored bodies
+BODY_CHUNK_SIZE = 1024 * 1024
+
+INDEXES = """
+CREATE INDEX packages_package ON packages(package, version_key);
+CREATE INDEX packages_version ON packages(version_key);
+CREATE INDEX packages_section ON packages(section_id);
+"""
+
+# Columns selected to rebuild a package entry, see decode_row()
+SELECT_PACKAGES = """
+SELECT p.layout_id, p.record, p.id, p.package, p.version, p.version_key, a.value, m.value, s.value, pr.value
+FROM packages p
+LEFT JOIN strings a ON a.id = p.architecture_id
+LEFT JOIN strings m ON m.id = p.maintainer_id
+LEFT JOIN strings s ON s.id = p.section_id
+LEFT JOIN strings pr ON pr.id = p.priority_id
+"""
+
+class SnapshotWriter:
+    """
+    Write package entries to a new SQLite snapshot, one at a time.
+
+    The snapshot is built in a temporary file and renamed into place when the writer is closed,
+    so readers never see a partial snapshot. Use it as a context manager.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.tmp_path = f"{output_path}.tmp"
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+        self.connection = sqlite3.connect(self.tmp_path)
+        self.connection.executescript(SCHEMA)
+        self.connection.execute(f"PRAGMA user_version = {SNAPSHOT_VERSION}")
+        self.strings = {}
+        self.layouts = {}
+        self.count = 0
+
+        # The full list is compressed as the packages are added, into temporary files
+        # (one per content coding), so it never has to be held in memory
+        directory = os.path.dirname(os.path.abspath(output_path))
+        self.bodies = {}
+        # Content coding -> (compress, finish) functions of a streaming compressor
+        gzip_compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.compressors = {"gzip": (gzip_compressor.compress, gzip_compressor.flush)}
+        if brotli is not None:
+            brotli_compressor = brotli.Compressor(quality=5)
+            self.compressors["br"] = (brotli_compressor.process, brotli_compressor.finish)
+        for encoding in self.compressors:
+            self.bodies[encoding] = tempfile.TemporaryFile(dir=directory)
+        # ETag and size of the uncompressed JSON
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.write_body(b"[")
+
+    def intern(self, value):
+        """
+        Return the id of a string in the strings table, adding it if needed.
+        """
+
+        if value is None:
+            return None
+        string_id = self.strings.get(value)
+        if string_id is None:
+            string_id = len(self.strings) + 1
+            self.strings[value] = string_id
+            self.connection.execute("INSERT INTO strings (id, value) VALUES (?, ?)", (string_id, value))
+        return string_id
+
+    def layout(self, fields):
+        """
+        Return the id of a list of field names in the layouts table, adding it if needed.
+        """
+
+        fields = tuple(fields)
+        layout_id = self.layouts.get(fields)
+        if layout_id is None:
+            layout_id = len(self.layouts) + 1
+            self.layouts[fields] = layout_id
+            self.connection.execute("INSERT INTO layouts (id, fields) VALUES (?, ?)", (layout_id, json.dumps(fields)))
+        return layout_id
+
+    def add(self, package):
+        """
+        Add a package entry (as produced by json_parser.parse_packages()) to the snapshot.
+        """
+
+        # Version keys are only stored in their column, even if an earlier json_parser.py wrote them in the entry
+        package = {key: value for key, value in package.items() if key != "version_key"}
+
+        # The layout keeps the field order, the record only the values that have no column
+        values = [value for key, value in package.items() if key not in COLUMN_FIELDS]
+
+        self.connection.execute(
+            "INSERT INTO packages (id, package, version, version_key, architecture_id, maintainer_id, section_id, priority_id, layout_id, record) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                package.get("id"),
+                package.get("Package", ""),
+                package.get("Version"),
+                # A package without a Version sorts like version "0", as in package_store.package_version_key()
+                version_key(package.get("Version") or ""),
+                *(self.intern(package.get(field)) for field in INTERNED_FIELDS),
+                self.layout(package),
+                zlib.compress(json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), RECORD_COMPRESSION_LEVEL),
+            ),
+        )
+
+        # Same encoding as package_store.SerializedList
+        encoded = json.dumps(package, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        self.write_body(b"," + encoded if self.count else encoded)
+        self.count += 1
+
+    def write_body(self, data):
+        """
+        Append data to the encoded full list, in every content coding.
+        """
+
+        self.digest.update(data)
+        self.size += len(data)
+        for encoding, (compress, _) in self.compressors.items():
+            self.bodies[encoding].write(compress(data))
+
+    def store_bodies(self):
+        """
+        Finish the encoded full list and copy each content coding into the bodies table.
+        """
+
+        self.write_body(b"]")
+        for encoding, (_, finish) in self.compressors.items():
+            self.bodies[encoding].write(finish())
+
+        for encoding, file in self.bodies.items():
+            size = file.tell()
+            file.seek(0)
+            cursor = self.connection.execute("INSERT INTO bodies (encoding, body) VALUES (?, zeroblob(?))", (encoding, size))
+            with self.connection.blobopen("bodies", "body", cursor.lastrowid) as blob:
+                shutil.copyfileobj(file, blob, BODY_CHUNK_SIZE)
+            file.close()
+
+        self.connection.executemany("INSERT INTO metadata (key, value) VALUES (?, ?)",
+                                    (("etag", self.digest.hexdigest()[:32]), ("size", str(self.size))))
+
+    def close(self):
+        """
+        Store the encoded full list, create the indexes and publish the snapshot.
+        """
+
+        self.store_bodies()
+        self.connection.executescript(INDEXES)
+        self.connection.commit()
+        self.connection.execute("ANALYZE")
+        self.connection.close()
+        os.replace(self.tmp_path, self.output_path)
+
+    def abort(self):
+        """
+        Discard the snapshot being written.
+        """
+
+        for file in self.bodies.values():
+            file.close()
+        self.connection.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def open_snapshot(path):
+    """
+    Open a snapshot read-only, with its pages memory-mapped and shared with other processes.
+
+    Args:
+        path (str): Path of the snapshot.
+
+    Returns:
+        sqlite3.Connection: The connection, usable from any thread as long as calls are serialized.
+
+    Raises:
+        ValueError: If the snapshot was written by another version of sqlite_snapshot.py.
+    """
+
+    # immutable=1: published snapshots are never modified in place, only replaced
+    connection = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+    if snapshot_version(connection) != SNAPSHOT_VERSION:
+        connection.close()
+        raise ValueError(f"{path} was written by another version of sqlite_snapshot.py, it must be rebuilt")
+    connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    return connection
+
+def snapshot_version(connection):
+    """
+    Return the layout version of a snapshot, see SNAPSHOT_VERSION.
+    """
+
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+def is_current_snapshot(path):
+    """
+    Check whether a snapshot was written with the current SNAPSHOT_VERSION.
+    """
+
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return snapshot_version(connection) == SNAPSHOT_VERSION
+    finally:
+        connection.close()
+
+def read_layouts(connection):
+    """
+    Read the layouts of a snapshot, to pass to decode_row().
+
+    Returns:
+        dict: Layout id -> tuple of field names.
+    """
+
+    return {layout_id: tuple(json.loads(fields)) for layout_id, fields in connection.execute("SELECT id, fields FROM layouts")}
+
+def decode_row(row, layouts):
+    """
+    Rebuild a package entry from a row selected with SELECT_PACKAGES.
+    """
+
+    layout_id, record, *columns = row
+    values = iter(json.loads(zlib.decompress(record)))
+    columns = dict(zip(COLUMN_FIELDS, columns))
+    return {field: columns[field] if field in columns else next(values) for field in layouts[layout_id]}
+
+def stored_list(connection):
+    """
+    Describe the full list stored in a snapshot.
+
+    Returns:
+        tuple: The ETag and the size of the uncompressed JSON, and a dict of the stored
+               content codings -> (rowid, size) of their body, see read_body_chunk().
+    """
+
+    metadata = dict(connection.execute("SELECT key, value FROM metadata"))
+    bodies = {encoding: (rowid, size) for encoding, rowid, size in connection.execute("SELECT encoding, rowid, length(body) FROM bodies")}
+    return metadata["etag"], int(metadata["size"]), bodies
+
+def read_body_chunk(connection, rowid, offset, size):
+    """
+    Read a chunk of a body stored in a snapshot, without loading the rest of it.
+
+    Returns:
+        bytes: Up to size bytes of the body, from offset.
+    """
+
+    with connection.blobopen("bodies", "body", rowid, readonly=True) as blob:
+        blob.seek(offset)
+        return blob.read(size)
+
+def write_snapshot(packages, output_path):
+    """
+    Write a snapshot from package entries, e.g. the content of an existing Packages.json.
+
+    Returns:
+        int: The number of packages written.
+    """
+
+    with SnapshotWriter(output_path) as snapshot:
+        for package in packages:
+            snapshot.add(package)
+    return snapshot.count
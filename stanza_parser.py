@@ -0,0 +1,145 @@
+# This module reads Parrot/Debian Packages files one line at a time.
+
+# A Packages file is a sequence of stanzas separated by blank lines. Each stanza is
+# a list of "Key: value" fields, and a field continues on the following lines when
+# they start with a space or a tab (this is how Description and Tag are written).
+
+# The functions below parse this format natively, in a single pass, so a whole
+# Packages file never has to be loaded in memory, split with regexes, or rewritten
+# before it can be converted to JSON.
+
+# It also holds the helpers shared by the scripts that process Packages files
+# (json_parser.py and format_packages.py).
+
+import os
+import gzip
+import lzma
+import logging
+
+def open_packages(path):
+    """
+    Open a Packages file for reading as text, decompressing it on the fly if needed.
+
+    Args:
+        path (str): Path to a Packages, Packages.gz or Packages.xz file.
+
+    Returns:
+        file: A text file object that can be iterated line by line.
+    """
+
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+def iter_raw_stanzas(lines):
+    """
+    Split a stream of lines into stanzas without altering any field.
+
+    Args:
+        lines (iterable): Lines of a Packages file, with or without trailing newlines.
+
+    Yields:
+        list: One list per stanza, containing [key, value, continuation_lines] for each field,
+              where value is the text after "Key:" on the first line and continuation_lines
+              are the following indented lines, unchanged.
+    """
+
+    fields = []
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+
+        # A blank line ends the current stanza
+        if not line.strip():
+            if fields:
+                yield fields
+                fields = []
+            continue
+
+        # An indented line continues the previous field
+        if line[0] in ' \t':
+            if fields:
+                fields[-1][2].append(line)
+            continue
+
+        key, _, value = line.partition(':')
+        fields.append([key.strip(), value.strip(), []])
+
+    if fields:
+        yield fields
+
+def fold_value(key, value, continuation_lines):
+    """
+    Fold a multi-line field into a single line.
+
+    Args:
+        key (str): The field name.
+        value (str): The text on the first line of the field.
+        continuation_lines (list): The indented lines that continue the field.
+
+    Returns:
+        str: The field value on a single line.
+    """
+
+    if not continuation_lines:
+        return value
+
+    # Tag is a comma-separated list, any run of whitespace becomes a single space
+    if key == 'Tag':
+        return ' '.join(' '.join([value] + continuation_lines).split())
+
+    # Other fields (e.g. Description) keep their text, one space between lines
+    parts = [value] if value else []
+    parts.extend(line.strip() for line in continuation_lines if line.strip())
+    return ' '.join(parts)
+
+def iter_stanzas(lines):
+    """
+    Parse a stream of lines into one dictionary per stanza, folding multi-line fields.
+
+    Args:
+        lines (iterable): Lines of a Packages file, with or without trailing newlines.
+
+    Yields:
+        dict: The fields of each stanza, in file order.
+    """
+
+    for fields in iter_raw_stanzas(lines):
+        stanza = {}
+
+        for key, value, continuation_lines in fields:
+            value = fold_value(key, value, continuation_lines)
+
+            # A repeated field is kept on separate lines, as parse_packages() always did
+            if key in stanza:
+                stanza[key] += '\n' + value
+            else:
+                stanza[key] = value
+
+        yield stanza
+
+def read_files_from(list_path):
+    """
+    Read a list of Packages files to process, such as the --changed-list written by repo_downloader.py.
+
+    Args:
+        list_path (str): Path to a file containing one Packages path per line.
+
+    Returns:
+        set: Absolute paths of the listed files.
+    """
+
+    with open(list_path, 'r', encoding='utf-8') as file:
+        return {os.path.abspath(line.strip()) for line in file if line.strip()}
+
+def init_worker():
+    """
+    Initialize a worker process: its log records are dropped, the parent process logs the results.
+    """
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.NullHandler())